@@ -31,7 +31,7 @@ def AddAvailableLibs(env, libs):
 	Scans through a list of libraries and adds
 	available libraries to the environment.
 	"""
-	conf = env.Configure()
+	conf = CachedConfigure(env)
 
 	for lib in libs:
 		conf.CheckLib(lib)
@@ -61,7 +61,7 @@ def AddZLib(env, platform, alias='install-utils'):
 	# Avoid unnecessary configuring when cleaning targets 
 	# and a clash when scons is run in parallel operation.
 	if not env.GetOption('clean'):
-		conf = env.Configure()
+		conf = CachedConfigure(env)
 		if not conf.CheckLibWithHeader(zlib, 'zlib.h', 'c'):
 			print('zlib (%s) is missing!' % (platform))
 			Exit(1)
@@ -74,7 +74,7 @@ def GetAvailableLibs(env, libs):
 	Scans through a list list of libraries and adds
 	available libraries to the environment.
 	"""
-	conf = env.Configure()
+	conf = CachedConfigure(env)
 	avail_libs = []
 
 	for lib in libs:
@@ -152,7 +152,297 @@ def FlagsConfigure(env):
 	  CheckCompileFlag - checks for a compiler flag
 		CheckLinkFlag    - checks for a linker flag
 	"""
-	return env.Configure(custom_tests = { 'CheckCompileFlag' : check_compile_flag, 'CheckLinkFlag': check_link_flag })
+	return CachedConfigure(env, custom_tests = { 'CheckCompileFlag' : check_compile_flag, 'CheckLinkFlag': check_link_flag })
+
+#
+# Configure cache
+#
+# Check results are stored in $CONFIGURE_CACHE, shared by every environment of a build and by every
+# build variant (BUILD_ROOT, BUILD_PREFIX). An entry is keyed on the toolchain identity (path, size and
+# time stamp of the compiler binaries), the build flags, the check function and its arguments, so
+# a different compiler or different flags simply miss the cache.
+#
+# Checks alter the environment (i.e. CheckLib appends to LIBS), cached results replay these changes.
+#
+
+configure_cache = None
+configure_cache_file = None
+configure_cache_dirty = False
+configure_cache_tools = {}
+configure_cache_key_vars = ['CCFLAGS', 'CFLAGS', 'CXXFLAGS', 'CPPDEFINES', 'CPPPATH', 'LINKFLAGS', 'LIBPATH', 'LIBS']
+configure_cache_replay_vars = ['LIBS', 'CCFLAGS', 'LINKFLAGS']
+
+def ConfigureCacheLoad(env):
+	import atexit, json
+	global configure_cache, configure_cache_file
+	if configure_cache is None:
+		configure_cache = {}
+		if env.get('CONFIGURE_CACHE'):
+			configure_cache_file = env.File(env['CONFIGURE_CACHE']).abspath
+			try:
+				with open(configure_cache_file) as fin:
+					configure_cache = json.load(fin)
+			except (OSError, ValueError):
+				pass
+			atexit.register(ConfigureCacheSave)
+	return configure_cache if configure_cache_file else None
+
+def ConfigureCacheSave():
+	import json, os
+	if not configure_cache_dirty:
+		return
+	# merge with the entries written by concurrent builds (i.e. other BUILD_ROOT variants)
+	cache = {}
+	try:
+		with open(configure_cache_file) as fin:
+			cache = json.load(fin)
+	except (OSError, ValueError):
+		pass
+	cache.update(configure_cache)
+	tmpfile = '%s.%d.tmp' % (configure_cache_file, os.getpid())
+	try:
+		with open(tmpfile, 'w') as fout:
+			json.dump(cache, fout, indent=1, sort_keys=True)
+		os.replace(tmpfile, configure_cache_file)
+	except OSError:
+		pass
+
+def ConfigureToolIdentity(env):
+	import os
+	identity = []
+	for var in ['CC', 'CXX', 'LINK']:
+		tool = env.subst('$' + var).split()
+		if not tool:
+			continue
+		exe = env.WhereIs(tool[0]) or tool[0]
+		if exe not in configure_cache_tools:
+			try:
+				st = os.stat(exe)
+				configure_cache_tools[exe] = [exe, st.st_size, getattr(st, 'st_mtime_ns', st.st_mtime)]
+			except OSError:
+				configure_cache_tools[exe] = [exe]
+		identity.append(configure_cache_tools[exe])
+	return identity
+
+def ConfigureCacheKey(env, test, args, kw):
+	import hashlib, json, marshal
+	code = getattr(test, '__code__', None)
+	data = {
+		'tools': ConfigureToolIdentity(env),
+		'flags': [env.subst('$' + var) for var in configure_cache_key_vars],
+		'env': [env['ENV'].get(var) for var in ['PATH', 'INCLUDE', 'LIB']],
+		'test': hashlib.sha256(marshal.dumps(code)).hexdigest() if code else test.__name__,
+		'args': [str(arg) for arg in args],
+		'kw': sorted([(k, str(v)) for k, v in kw.items()]),
+	}
+	return hashlib.sha256(json.dumps(data, sort_keys=True).encode()).hexdigest()
+
+def ConfigureEnvSnapshot(env):
+	import SCons.Util
+	return dict((var, [str(item) for item in SCons.Util.flatten(env.get(var, []))]) for var in configure_cache_key_vars)
+
+def CachedCheck(conf, name, check, test, cache):
+	"""
+	Wraps a configure check, the result and the changes the check made to the environment are cached.
+	"""
+	def cached(*args, **kw):
+		global configure_cache_dirty
+		env = conf.env
+		key = ConfigureCacheKey(env, test, args, kw)
+		entry = cache.get(key)
+		if entry is not None and env.GetOption('config') != 'force':
+			# code snippets are passed as arguments too, only show their first line
+			shown = [str(arg).strip().split('\n')[0][:40] for arg in args]
+			print('Checking %s(%s)... (cached) %s' % (name, ', '.join(shown), 'yes' if entry['result'] else 'no'))
+			for var, items in entry['append'].items():
+				env.Append(**{var: items})
+			return entry['result']
+		before = ConfigureEnvSnapshot(env)
+		result = check(*args, **kw)
+		after = ConfigureEnvSnapshot(env)
+		append = {}
+		for var in configure_cache_key_vars:
+			if after[var] == before[var]:
+				continue
+			if var not in configure_cache_replay_vars or after[var][:len(before[var])] != before[var]:
+				return result   # not reproducible by appending, don't cache
+			append[var] = after[var][len(before[var]):]
+		if isinstance(result, (bool, int, str)):
+			cache[key] = {'check': name, 'args': [str(arg) for arg in args], 'result': result, 'append': append}
+			configure_cache_dirty = True
+		return result
+	return cached
+
+def CachedConfigure(env, custom_tests = {}, **kw):
+	"""
+	Wrapper for env.Configure that caches the results of the Check* tests (including the custom tests)
+	in $CONFIGURE_CACHE. Empty CONFIGURE_CACHE or `--config=force` disable the cache.
+	"""
+	import SCons.SConf
+	conf = env.Configure(custom_tests = custom_tests, **kw)
+	cache = ConfigureCacheLoad(env)
+	if cache is None:
+		return conf
+	builtin_tests = {
+		'CheckLib': SCons.SConf.CheckLib,
+		'CheckLibWithHeader': SCons.SConf.CheckLibWithHeader,
+		'CheckHeader': SCons.SConf.CheckHeader,
+		'CheckCHeader': SCons.SConf.CheckCHeader,
+		'CheckCXXHeader': SCons.SConf.CheckCXXHeader,
+		'CheckFunc': SCons.SConf.CheckFunc,
+		'CheckType': SCons.SConf.CheckType,
+		'CheckDeclaration': SCons.SConf.CheckDeclaration,
+	}
+	for name, test in list(builtin_tests.items()) + list(custom_tests.items()):
+		if hasattr(conf, name):
+			setattr(conf, name, CachedCheck(conf, name, getattr(conf, name), test, cache))
+	return conf
+
+#
+# NSIS script scanner
+#
+# Implicit dependencies of the .nsi/.nsh files compiled during the build (headers, packaged files,
+# plug-ins, stubs, makensis), resolved by nsis_test_scripts.DependencyScanner against the build nodes
+# instead of the file system: files of a distribution directory are found before they are installed
+# and are read from their source until then.
+#
+
+def NSISScanner(env, nsisdir):
+	"""
+	Scanner for scripts compiled by the makensis of `nsisdir`, with NSISDIR set to `nsisdir`.
+	The distribution is only looked up on the first scan, once every SConscript declared its files.
+	"""
+	import os, SCons.Node.FS, SCons.Scanner
+	from nsis_test_scripts import DependencyScanner
+
+	class NodeDependencyScanner(DependencyScanner):
+		def find(self, pattern):
+			# fs.Glob, env.Glob would substitute the NSIS variables
+			return [(node.abspath, isinstance(node, SCons.Node.FS.Dir)) for node in env.fs.Glob(os.path.normpath(pattern))]
+		def tree(self, dir):
+			files = []
+			for path, isdir in self.find(os.path.join(dir, '*')):
+				files.extend(self.tree(path) if isdir else [path])
+			return sorted(files)
+		def read(self, file):
+			node = env.File(file)
+			while not node.exists() and node.sources:
+				node = node.sources[0]	# not installed yet
+			return node.get_contents() if node.exists() else b''
+
+	deps = []
+	def scan(node, env, path):
+		if not deps:
+			dir = env.Dir(nsisdir)
+			makensis = env.FindFile('makensis$PROGSUFFIX', [dir, dir.Dir('Bin')])
+			deps.append(NodeDependencyScanner(dir.abspath, makensis.abspath if makensis else 'makensis_not_found'))
+		files, cacheable = deps[0].scan(node.abspath)
+		nodes = [env.File(file) for file in files if file != node.abspath]
+		return [n for n in nodes if n.exists() or n.is_derived()]
+	return SCons.Scanner.Scanner(function = scan, name = 'NSISScanner', skeys = ['.nsi', '.nsh'])
+
+#
+# Build cache
+#
+# $CACHE_DIR is a content addressed cache of the files built under $BUILD_PREFIX (objects, libraries,
+# executables), shared by every build variant and architecture. SCons keys an entry on the build
+# signature of the file (sources, included headers, command line); the key is extended with the
+# toolchain identity and the generated nsis-sconf.h, so builds with another compiler or another
+# NSIS_MAX_STRLEN/NSIS_CONFIG_LOG never share entries.
+#
+# Hits and misses are reported at the end of the build, then the cache is pruned to $CACHE_SIZE MiB,
+# least recently used (retrieved or pushed) entries first.
+#
+
+build_cache_stats = {'hits': 0, 'misses': 0, 'pushed': 0}
+
+def BuildCache(env):
+	"""
+	Enable the build cache of `env` and of the environments cloned from it.
+	Must be called once nsis-sconf.h is written.
+	"""
+	import atexit, hashlib, json, os, threading, SCons.Action, SCons.CacheDir, SCons.Util
+
+	config = env.File('#$BUILD_CONFIG/nsis-sconf.h').get_contents()
+	prefix = env.Dir('#$BUILD_PREFIX').abspath + os.sep
+	keys = {}
+	lock = threading.Lock()
+
+	class NSISCacheDir(SCons.CacheDir.CacheDir):
+		def key(self, node):
+			env = node.get_build_env()
+			tools = tuple(env.subst('$' + var) for var in ['CC', 'CXX', 'LINK'])
+			if tools not in keys:
+				data = {'tools': ConfigureToolIdentity(env), 'config': hashlib.sha256(config).hexdigest()}
+				keys[tools] = json.dumps(data, sort_keys=True)
+			return keys[tools]
+		def cachepath(self, node):
+			if not self.is_enabled():
+				return None, None
+			sig = SCons.Util.hash_signature(node.get_cachedir_bsig() + self.key(node))
+			cachedir = os.path.join(self.path, sig[:self.config['prefix_len']].upper())
+			return cachedir, os.path.join(cachedir, sig)
+		def cacheable(self, node):
+			# dist directories only hold copies of the built files
+			return node.get_abspath().startswith(prefix)
+		def retrieve(self, node):
+			if not self.cacheable(node):
+				return False
+			hit = super().retrieve(node)
+			if self.is_enabled() and SCons.Action.execute_actions:
+				with lock:
+					build_cache_stats['hits' if hit else 'misses'] += 1
+			return hit
+		def push(self, node):
+			if not self.cacheable(node) or node.nocache:
+				return None
+			if self.is_enabled() and not self.is_readonly():
+				with lock:
+					build_cache_stats['pushed'] += 1
+			return super().push(node)
+
+	env.CacheDir(env['CACHE_DIR'], NSISCacheDir)
+	atexit.register(BuildCacheReport, env.Dir(env['CACHE_DIR']).abspath, int(env['CACHE_SIZE']) * 1024 * 1024)
+
+def BuildCacheReport(cachedir, maxsize):
+	lookups = build_cache_stats['hits'] + build_cache_stats['misses']
+	if not lookups:
+		return
+	print('Build cache: %d hits, %d misses (%.1f%% hit rate), %d files pushed' % (build_cache_stats['hits'], build_cache_stats['misses'],
+		100.0 * build_cache_stats['hits'] / lookups, build_cache_stats['pushed']))
+	if build_cache_stats['pushed'] and maxsize > 0:
+		removed, freed = BuildCachePrune(cachedir, maxsize)
+		if removed:
+			print('Build cache: pruned %d files (%.1f MiB) to stay under %d MiB' % (removed, freed / 1048576.0, maxsize // 1048576))
+
+def BuildCachePrune(cachedir, maxsize):
+	"""
+	Delete the least recently used entries of `cachedir` until it holds at most `maxsize` bytes.
+	SCons touches the entries it retrieves, the modification time is the last use.
+	Returns the number of deleted files and their total size.
+	"""
+	import os
+	entries, total = [], 0
+	for subdir in os.listdir(cachedir):
+		if not os.path.isdir(os.path.join(cachedir, subdir)):
+			continue	# config, CACHEDIR.TAG
+		for file in os.listdir(os.path.join(cachedir, subdir)):
+			try:
+				st = os.stat(os.path.join(cachedir, subdir, file))
+			except OSError:
+				continue	# pruned by a concurrent build
+			entries.append((st.st_mtime, st.st_size, os.path.join(cachedir, subdir, file)))
+			total += st.st_size
+	removed, freed = 0, 0
+	for mtime, size, file in sorted(entries):
+		if total - freed <= maxsize:
+			break
+		try:
+			os.remove(file)
+		except OSError:
+			continue
+		removed, freed = removed + 1, freed + size
+	return removed, freed
 
 def GetOptionOrEnv(name, defval = None):
 	"""
@@ -328,13 +618,17 @@ def WriteResourceVersion(rcfile, v1, v2, v3=0, v4=0, file_version=True, product_
             lines.append(line)
 
     if replaced > 0:
-        with open(file.name, 'w') as file:
+        # write a temporary file and swap it in, concurrent builds (i.e. BUILD_ROOT=build-x86 and BUILD_ROOT=build-amd64)
+        # share the same source tree and must never see a partially written .rc file
+        tmpfile = f"{rcfile}.{os.getpid()}.tmp"
+        with open(tmpfile, 'w') as file:
             for line in lines:
                 file.write(line)
-            return True
+        os.replace(tmpfile, rcfile)
+        return True
     else:
         if verbose: print("file already up-to-date")
     return False
 
-Export('GetStdSysEnvVarList AddAvailableLibs AddZLib GenerateTryLinkCode FlagsConfigure GetAvailableLibs GetOptionOrEnv SilentActionEcho IsPEExecutable SetPESecurityFlagsWorker SetPEMinOS MakeReproducibleAction')
+Export('GetStdSysEnvVarList AddAvailableLibs AddZLib GenerateTryLinkCode FlagsConfigure CachedConfigure NSISScanner BuildCache GetAvailableLibs GetOptionOrEnv SilentActionEcho IsPEExecutable SetPESecurityFlagsWorker SetPEMinOS MakeReproducibleAction')
 Export('WriteResourceVersion')
@@ -79,7 +79,9 @@
     #ifndef NSIS_COMPRESS_USE_ZLIB
       #ifndef NSIS_COMPRESS_USE_BZIP2
         #ifndef NSIS_COMPRESS_USE_LZMA
-          #error compression is enabled but zlib, bzip2 and lzma are disabled.
+          #ifndef NSIS_COMPRESS_ANY // objects shared by the stubs of all compressors
+            #error compression is enabled but zlib, bzip2 and lzma are disabled.
+          #endif
         #endif
       #endif
     #endif
@@ -1,7 +1,9 @@
 from os import path
-import os, sys, shutil, json
+import os, sys, shutil, json, hashlib, time
 from subprocess import Popen, PIPE
 from nsis_version import *
+import nsis_trace
+from nsis_trace import run_traced
 
 # requirements:
 # pacman -S mingw-w64-i686-toolchain
@@ -9,11 +11,16 @@ from nsis_version import *
 # pacman -S libtool autoconf-wrapper automake-wrapper     (cppunit)
 
 scriptdir = path.dirname(path.abspath(__file__))
+cppunit_version = '1.15.1'
+cppunit_sha256 = '89c5c6665337f56fd2db36bc3805a5619709d51fb136e51937072f63fcc717a7'
+cppunit_url = 'https://dev-www.libreoffice.org/src/cppunit-{version}.tar.gz'
+zlib_url = 'https://github.com/madler/zlib.git'
+zlib_revision = 'v1.3.1'
 
-def run(args):
+def run(args, cwd=None):
     """ Execute subprocess and raise exit code exceptions. """
     print(f">> {args}")
-    exitcode = Popen(args).wait()
+    exitcode = run_traced(args, cwd=cwd)
     if exitcode != 0:
         raise OSError(exitcode, f"subprocess exit code {exitcode}")
 
@@ -24,22 +31,74 @@ def win_to_posix(path):
         return '/' + path.replace(':', '').replace('\\', '/')
     return path
 
+def cpu_count():
+    """ Number of CPU cores available to this process. """
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+def job_count(jobs=None):
+    """
+    Number of parallel jobs for the next build step.
+    Returns `jobs` if set, otherwise the share published by the orchestrator in the `NSIS_JOBS_FILE` file
+    (updated by `nsis_build_local.py` when a concurrent build finishes), otherwise all available cores.
+    """
+    if jobs:
+        return max(1, jobs)
+    if jobsfile := os.environ.get('NSIS_JOBS_FILE'):
+        try:
+            with open(jobsfile) as fin:
+                return max(1, int(fin.read()))
+        except (OSError, ValueError):
+            pass
+    return cpu_count()
+
+
+def with_jobs(args, jobs):
+    """ Add the parallel jobs option to a `make`, `mingw32-make`, `msbuild` or `scons` command line. """
+    for i, arg in enumerate(args):
+        tool = path.splitext(path.basename(arg))[0].lower()
+        if tool in ['make', 'mingw32-make', 'scons']:
+            return args[:i+1] + [f'-j{jobs}'] + args[i+1:]
+        if tool == 'msbuild':
+            return args[:i+1] + [f'/m:{jobs}'] + [a for a in args[i+1:] if a.lower() != '/m']
+    return args
+
+
 def validate_compatibility_with_htmlhelp(filepath):
     for item in path.normpath(filepath).split(os.sep):
         if item.startswith('.'):
             raise Exception(f'directory "{filepath}" is incompatible with "HTML Help Workshop" because "{item}" starts with a dot. "NSIS.chm" will fail to build')
 
-def setup_mingw_environ(arch):
+def tool_version(args):
+    """ First line printed by `args` (i.e. `gcc --version`), or `None` if the tool can't run. """
+    try:
+        process = Popen(args, stdout=PIPE, stderr=PIPE)
+        cout, cerr = process.communicate()
+    except OSError:
+        return None
+    lines = (cout or cerr).decode('utf-8', errors='replace').strip().splitlines()
+    return lines[0].strip() if process.returncode == 0 and lines else None
+
+
+def find_mingw_toolchain(arch):
     """
     Based on the target architecture, this function:
-    - Looks for `msys2` installation directory and adds it to `PATH`
-    - Looks for `mingw-w64` installation directory and adds it to `PATH`
+    - Looks for `msys2` and `mingw-w64` installation directories (Windows)
+    - Verifies that the `mingw-w64` cross toolchain is installed (Linux)
 
     Returns:
-      Dictionary `{"msysdir": str, "mingwdir": str}`
+      Dictionary `{"vars": {"msysdir": str, "mingwdir": str, "prefix": str}, "path": [str], "tools": {name: str}, "versions": {name: str}}`
     """
     if os.name != 'nt':
-        return None
+        prefix = {'x86': 'i686-w64-mingw32-', 'amd64': 'x86_64-w64-mingw32-'}[arch]
+        tools = {tool: shutil.which(prefix + tool) for tool in ['gcc', 'g++', 'windres', 'ar', 'strip']}
+        missing = [prefix + tool for tool, exe in tools.items() if exe is None]
+        if missing: raise Exception(f"{arch} cross toolchain not found ({', '.join(missing)}). Install mingw-w64")
+        print(f"-- cross prefix = {prefix}")
+        return {'vars': {'prefix': prefix}, 'path': [], 'tools': tools,
+                'versions': {'gcc': tool_version([tools['gcc'], '--version'])}}
 
     cdrive = os.environ['SystemDrive'] + path.sep
     mingwXX = lambda arch: 'mingw64' if arch == 'amd64' else 'mingw32'
@@ -51,7 +110,6 @@ def setup_mingw_environ(arch):
             break
     if msysdir is None: raise Exception('msys2 not found')
     print(f"-- msysdir = {msysdir}")
-    os.environ["PATH"] = path.join(msysdir, 'usr', 'bin') + os.pathsep + os.environ["PATH"]   # i.e r"C:\msys64\usr\bin"
 
     mingwdir = None
     for subdir in [path.join(cdrive, mingwXX(arch)),
@@ -61,24 +119,25 @@ def setup_mingw_environ(arch):
             break
     if mingwdir is None: raise Exception(f"{mingwXX(arch)} not found")
     print(f"-- mingwdir = {mingwdir}")
-    os.environ["PATH"] = path.join(mingwdir, 'bin') + os.pathsep + os.environ["PATH"]     # i.e. r"C:\msys64\mingw32\bin", r"C:\mingw32\bin"
 
-    return {'msysdir': msysdir, 'mingwdir': mingwdir}
+    tools = {'gcc': path.join(mingwdir, 'bin', 'gcc.exe'), 'sh': path.join(msysdir, 'usr', 'bin', 'sh.exe')}
+    return {'vars': {'msysdir': msysdir, 'mingwdir': mingwdir, 'prefix': ''},
+            'path': [path.join(mingwdir, 'bin'),          # i.e. r"C:\msys64\mingw32\bin", r"C:\mingw32\bin"
+                     path.join(msysdir, 'usr', 'bin')],   # i.e r"C:\msys64\usr\bin"
+            'tools': tools,
+            'versions': {'gcc': tool_version([tools['gcc'], '--version'])}}
 
 
-def setup_msvc_environ(arch):
+def find_msvc_toolchain(arch):
     """
     This function:
-    - Looks for Visual Studio and adds the location of `vcvarsall.bat` to `PATH`
+    - Looks for Visual Studio and the location of `vcvarsall.bat`
     - Guesses the platform toolset name (i.e. `v143`, `v142`, etc.)
     - Converts the target arch (x86|amd64) to Visual C++ arch (Win32|x64)
 
     Returns:
-      Dictionary `{"installationPath": str, "platformToolset": str, "archName": str}`
+      Dictionary `{"vars": {"installationPath": str, "platformToolset": str, "archName": str}, "path": [str], "tools": {name: str}, "versions": {name: str}}`
     """
-    if os.name != 'nt':
-        return None
-
     if path.exists(vswhere := path.join(os.environ.get('PROGRAMFILES(X86)', '*'), 'Microsoft Visual Studio', 'Installer', 'vswhere.exe')): pass
     elif path.exists(vswhere := path.join(os.environ.get('PROGRAMFILES', '*'), 'Microsoft Visual Studio', 'Installer', 'vswhere.exe')): pass
     else: raise Exception('vswhere.exe not found')
@@ -92,7 +151,6 @@ def setup_msvc_environ(arch):
     # VC install path
     instPath = jout[0]['installationPath']
     print(f"-- installationPath = {instPath}")
-    os.environ["PATH"] = path.join(instPath, 'VC', 'Auxiliary', 'Build') + os.pathsep + os.environ["PATH"]
 
     # guess the platform toolset version
     toolset = None
@@ -106,7 +164,84 @@ def setup_msvc_environ(arch):
     if vsarch == 'x86': vsarch = 'Win32'
     if vsarch == 'amd64': vsarch = 'x64'
 
-    return {'installationPath': instPath, 'platformToolset': toolset, 'archName': vsarch}
+    return {'vars': {'installationPath': instPath, 'platformToolset': toolset, 'archName': vsarch},
+            'path': [path.join(instPath, 'VC', 'Auxiliary', 'Build')],
+            'tools': {'vswhere': vswhere, 'vcvarsall': path.join(instPath, 'VC', 'Auxiliary', 'Build', 'vcvarsall.bat')},
+            'versions': {'msvc': jout[0].get('installationVersion')}}
+
+
+toolchains = {}
+
+def toolchain_cache_file():
+    """ Toolchain discovery cache, shared by all build steps and architectures. """
+    return os.environ.get('NSIS_TOOLCHAIN_CACHE') or path.join(scriptdir, '.depend', 'toolchain.json')
+
+
+def toolchain_key(compiler, arch):
+    """ Everything that can change the toolchain discovery result. """
+    names = ['PATH', 'SystemDrive', 'PROGRAMFILES', 'PROGRAMFILES(X86)']
+    # our own PATH entries don't count, otherwise the key changes after the first `setup_environ`
+    ours = sum([t['path'] for t in toolchains.values()], [])
+    environ = {name: os.environ.get(name) for name in names}
+    if environ['PATH'] is not None:
+        environ['PATH'] = os.pathsep.join(p for p in environ['PATH'].split(os.pathsep) if p not in ours)
+    return hashlib.sha256(json.dumps([compiler, arch, os.name, environ], sort_keys=True).encode()).hexdigest()
+
+
+def toolchain_stamps(tools):
+    """ Modification times of the toolchain executables. A changed stamp invalidates the cached toolchain. """
+    return {exe: os.stat(exe).st_mtime_ns for exe in tools.values() if exe and path.exists(exe)}
+
+
+def resolve_toolchain(compiler, arch):
+    """
+    Find the toolchain for `compiler` and `arch`, once.
+    The result is memorized in-process and persisted in the toolchain cache file (see `toolchain_cache_file()`).
+
+    Returns:
+      Dictionary `{"compiler": str, "arch": str, "vars": dict, "path": [str], "tools": {name: str}, "versions": {name: str}}`
+    """
+    if (compiler, arch) in toolchains:
+        return toolchains[(compiler, arch)]
+
+    key = toolchain_key(compiler, arch)
+    cachefile = toolchain_cache_file()
+    try:
+        with open(cachefile) as fin:
+            cached = json.load(fin)
+    except (OSError, ValueError):
+        cached = {}
+
+    toolchain = cached.get(key)
+    if toolchain is not None and toolchain_stamps(toolchain['tools']) != toolchain['stamps']:
+        print(f"-- {compiler}/{arch} toolchain changed")
+        toolchain = None
+
+    if toolchain is None:
+        with nsis_trace.span(f'toolchain-{compiler}-{arch}', 'step'):
+            toolchain = find_mingw_toolchain(arch) if compiler == 'gcc' else find_msvc_toolchain(arch)
+        toolchain.update({'compiler': compiler, 'arch': arch, 'stamps': toolchain_stamps(toolchain['tools'])})
+        # concurrent builds may race here, the worst case is a lost entry that gets rediscovered next time
+        cached[key] = toolchain
+        os.makedirs(path.dirname(cachefile), exist_ok=True)
+        tmpfile = f'{cachefile}.{os.getpid()}.tmp'
+        with open(tmpfile, 'w') as fout:
+            json.dump(cached, fout, indent=2)
+        os.replace(tmpfile, cachefile)
+    else:
+        print(f"-- {compiler}/{arch} toolchain (cached) = {toolchain['vars']}")
+    print(f"-- {compiler}/{arch} versions = {toolchain['versions']}")
+
+    toolchains[(compiler, arch)] = toolchain
+    return toolchain
+
+
+def prepend_path(dirs):
+    """ Prepend `dirs` to `PATH`, skipping the ones already there. """
+    current = os.environ.get('PATH', '').split(os.pathsep)
+    missing = [dir for dir in dirs if path.normcase(dir) not in map(path.normcase, current)]
+    if missing:
+        os.environ['PATH'] = os.pathsep.join(missing + current)
 
 
 def setup_environ(compiler, arch):
@@ -119,48 +254,224 @@ def setup_environ(compiler, arch):
     if arch == 'x64': arch = 'amd64'
     if arch != 'x86' and arch != 'amd64': raise Exception(f"unknown arch {arch}")
 
-    if compiler == 'gcc':
-        return [compiler, arch, setup_mingw_environ(arch)]
-    elif compiler == 'msvc':
-        return [compiler, arch, setup_msvc_environ(arch)]
+    toolchain = resolve_toolchain(compiler, arch)
+    prepend_path(toolchain['path'])
+    return [compiler, arch, toolchain['vars']]
 
 
-def git_checkout(url, dir, depth = 1):
-    """ Clone or Pull a git repository. """
-    curdir = path.curdir
-    if path.exists(path.join(dir, '.git')):
-        os.chdir(dir)
-        run(['git', 'pull'])
-    else:
-        parentdir = path.dirname(dir)
-        os.makedirs(parentdir, exist_ok=True)
-        os.chdir(parentdir)
-        run(['git', 'clone'] + (['--depth', str(depth)] if depth >= 1 else None) + [url, path.basename(dir)])
-    os.chdir(curdir)
+def git_rev_parse(dir, rev='HEAD'):
+    """ Resolve `rev` to a commit hash in repository `dir`, without network access. Returns `None` if unknown. """
+    if not path.exists(dir):
+        return None
+    process = Popen(['git', 'rev-parse', '--verify', '--quiet', f'{rev}^{{commit}}'], cwd=dir, stdout=PIPE, stderr=PIPE)
+    cout, cerr = process.communicate()
+    if process.returncode != 0:
+        return None
+    return cout.decode('utf-8').strip()
+
+
+def git_revision(dir):
+    """ Returns the commit hash checked out in `dir`, or `None` if `dir` is not a git working tree. """
+    return git_rev_parse(dir, 'HEAD')
+
 
+def git_checkout(url, dir, depth=1, revision=None, refcache=None):
+    """
+    Clone or update a git repository.
+
+    Arguments:
+    - depth:     history depth of the checkout. `0` fetches the full history
+    - revision:  pinned commit hash or tag. Only this revision is fetched, and there's no git traffic at all
+                 if it's already available locally. Without a pinned revision, the default branch is cloned or pulled
+    - refcache:  shared bare repository that stores the objects of every checkout (`git clone --reference`).
+                 Working trees borrow its objects through `objects/info/alternates`
+    """
+    depthargs = ['--depth', str(depth)] if depth >= 1 else []
+
+    if revision is None:
+        if path.exists(path.join(dir, '.git')):
+            run(['git', 'pull'], cwd=dir)
+        else:
+            os.makedirs(path.dirname(dir), exist_ok=True)
+            run(['git', 'clone'] + depthargs + [url, path.basename(dir)], cwd=path.dirname(dir))
+        return
+
+    if path.exists(path.join(dir, '.git')) and (commit := git_rev_parse(dir, revision)) is not None:
+        if commit == git_revision(dir):
+            print(f"-- {dir} already at {revision} ({commit})")
+        else:
+            run(['git', 'checkout', '--quiet', '--detach', commit], cwd=dir)
+        return
 
-def build_zlib(compiler, arch, zlibdir):
+    if not path.exists(path.join(dir, '.git')):
+        run(['git', 'init', '--quiet', dir])
+        run(['git', 'remote', 'add', 'origin', url], cwd=dir)
+
+    # fetch the pinned revision (only) into the object cache, or straight into the working tree
+    pinref = f'refs/pinned/{revision}'
+    if refcache is not None:
+        refcache = path.abspath(refcache)
+        if not path.exists(path.join(refcache, 'objects')):
+            run(['git', 'init', '--quiet', '--bare', refcache])
+        with open(path.join(dir, '.git', 'objects', 'info', 'alternates'), 'a+') as fout:
+            fout.seek(0)
+            if path.join(refcache, 'objects') not in fout.read().splitlines():
+                fout.write(path.join(refcache, 'objects') + '\n')
+        if (commit := git_rev_parse(refcache, pinref)) is None:
+            for attempt in range(3):    # concurrent builds may contend for the ref locks
+                try:
+                    run(['git', 'fetch', '--quiet', '--no-tags', url, f'+{revision}:{pinref}'], cwd=refcache)   # no --depth, shallow references are not supported
+                    break
+                except OSError:
+                    if attempt == 2: raise
+                    time.sleep(1)
+            commit = git_rev_parse(refcache, pinref)
+    else:
+        run(['git', 'fetch', '--quiet', '--no-tags'] + depthargs + ['origin', f'+{revision}:{pinref}'], cwd=dir)
+        commit = git_rev_parse(dir, pinref)
+
+    # remember the pin locally, so the next checkout resolves it without network access
+    run(['git', 'update-ref', pinref, commit], cwd=dir)
+    if commit != revision:
+        run(['git', 'update-ref', f'refs/tags/{revision}', commit], cwd=dir)
+    run(['git', 'checkout', '--quiet', '--detach', commit], cwd=dir)
+
+
+def dir_snapshot(dir, exclude=['.git', '.nsis-depend-key']):
+    """ Map every file under `dir` to its `(size, mtime_ns)`. Returns dictionary `{relpath: (size, mtime_ns)}`. """
+    snapshot = {}
+    for root, dirs, files in os.walk(dir):
+        dirs[:] = [d for d in dirs if d not in exclude]
+        for file in files:
+            if file in exclude:
+                continue
+            filepath = path.join(root, file)
+            st = os.lstat(filepath)
+            snapshot[path.relpath(filepath, dir)] = (st.st_size, st.st_mtime_ns)
+    return snapshot
+
+
+class DependCache:
+    """
+    Content-addressed store of prebuilt dependency outputs (`zlib`, `cppunit`).
+
+    Every entry is keyed on the dependency source revision, compiler, arch and build flags
+    and holds the files created or modified by the dependency build.
+    Entries are evicted in LRU order when the store grows beyond `max_size` bytes.
+    The store may be shared by concurrent builds (i.e. `build-local-*-x86` and `build-local-*-amd64`).
+    """
+    def __init__(self, cachedir, max_size=2*1024*1024*1024):
+        self.cachedir = path.abspath(cachedir)
+        self.max_size = max_size
+
+    @staticmethod
+    def key(name, revision, compiler, arch, args):
+        """ Compute the cache key of a dependency build. """
+        identity = json.dumps([name, revision, compiler, arch, os.name, [str(a) for a in args]])
+        return f"{name}-{arch}-{hashlib.sha256(identity.encode('utf-8')).hexdigest()[:32]}"
+
+    def restore(self, key, dir):
+        """ Copy the files of cache entry `key` into `dir`. Returns `False` on cache miss. """
+        entrydir = path.join(self.cachedir, key)
+        try:
+            with open(path.join(entrydir, 'manifest.json')) as fin:
+                manifest = json.load(fin)
+            for file in manifest['files']:
+                dstfile = path.join(dir, file)
+                os.makedirs(path.dirname(dstfile), exist_ok=True)
+                if path.lexists(dstfile):
+                    os.remove(dstfile)
+                shutil.copy2(path.join(entrydir, 'files', file), dstfile)
+            os.utime(path.join(entrydir, 'manifest.json'))    # LRU timestamp
+        except (OSError, ValueError, KeyError):
+            return False    # missing, incomplete or concurrently evicted entry
+        print(f"-- depend cache: restored {len(manifest['files'])} files ({manifest['size']} bytes) from {key}")
+        return True
+
+    def store(self, key, dir, files):
+        """ Publish `files` (relative to `dir`) as cache entry `key`, then evict old entries. """
+        entrydir = path.join(self.cachedir, key)
+        if path.exists(entrydir):
+            return
+        tmpdir = path.join(self.cachedir, f".tmp-{key}-{os.getpid()}")
+        shutil.rmtree(tmpdir, ignore_errors=True)
+        size = 0
+        for file in files:
+            dstfile = path.join(tmpdir, 'files', file)
+            os.makedirs(path.dirname(dstfile), exist_ok=True)
+            shutil.copy2(path.join(dir, file), dstfile)
+            size += path.getsize(dstfile)
+        os.makedirs(tmpdir, exist_ok=True)
+        with open(path.join(tmpdir, 'manifest.json'), 'w') as fout:
+            json.dump({'key': key, 'files': sorted(files), 'size': size}, fout, indent=2)
+        try:
+            os.rename(tmpdir, entrydir)     # atomic publish
+            print(f"-- depend cache: stored {len(files)} files ({size} bytes) as {key}")
+        except OSError:
+            shutil.rmtree(tmpdir, ignore_errors=True)     # another build published the same entry first
+        self.evict()
+
+    def evict(self):
+        """ Remove least recently used entries until the store fits in `max_size` bytes. """
+        entries = []
+        for key in os.listdir(self.cachedir):
+            if key.startswith('.tmp-'):
+                continue
+            try:
+                manifest = path.join(self.cachedir, key, 'manifest.json')
+                with open(manifest) as fin:
+                    entries.append([os.stat(manifest).st_mtime_ns, json.load(fin)['size'], key])
+            except (OSError, ValueError, KeyError):
+                continue
+        total = sum(e[1] for e in entries)
+        for mtime, size, key in sorted(entries):
+            if total <= self.max_size:
+                break
+            print(f"-- depend cache: evict {key} ({size} bytes)")
+            shutil.rmtree(path.join(self.cachedir, key), ignore_errors=True)
+            total -= size
+
+
+def cached_build(cache, key, dir, build):
+    """
+    Run `build()` for the dependency in `dir`, unless it's already built with the same `key`.
+    Outputs are restored from `cache` on hit, and published to `cache` on miss.
+    """
+    stamp = path.join(dir, '.nsis-depend-key')
+    if path.exists(stamp):
+        with open(stamp) as fin:
+            if fin.read().strip() == key:
+                print(f"-- {path.basename(dir)} already built ({key})")
+                return
+    if cache is None or not cache.restore(key, dir):
+        before = dir_snapshot(dir)
+        build()
+        after = dir_snapshot(dir)
+        if cache is not None:
+            cache.store(key, dir, [file for file, st in after.items() if before.get(file) != st])
+    with open(stamp, 'w') as fout:
+        fout.write(key)
+
+
+def build_zlib(compiler, arch, zlibdir, cache=None, jobs=None, share=1):
+    """ Build zlib in `zlibdir`. Uses `1/share` of the parallel jobs, counted when the build starts (see `job_count`). """
     compiler, arch, vars = setup_environ(compiler, arch)
-    curdir = path.curdir
-    os.chdir(zlibdir)
     if compiler == 'gcc' and os.name == 'nt':
         args = [f'mingw32-make.exe', '-fwin32/Makefile.gcc', f'LOC=-D_WIN32_WINNT=0x0400 -static', 'zlib1.dll']
     elif compiler == 'gcc' and os.name != 'nt':
-        prefixes = {'x86': 'i686-w64-mingw32-', 'amd64': 'x86_64-w64-mingw32-'}
-        args = ['make', '-fwin32/Makefile.gcc', f'PREFIX={prefixes[arch]}', 'LOC=-D_WIN32_WINNT=0x0400 -static', 'zlib1.dll']
+        args = ['make', '-fwin32/Makefile.gcc', f'PREFIX={vars["prefix"]}', 'LOC=-D_WIN32_WINNT=0x0400 -static', 'zlib1.dll']
     elif compiler == 'msvc':
         args = [f'cmd.exe', '/c', 'call', "vcvarsall.bat", arch, '&&', 'nmake.exe', '-f', 'win32/Makefile.msc', f'LOC=/MT', 'zlib1.dll', 'zdll.lib']
-    run(args)
-    os.chdir(curdir)
 
+    def build():
+        run(with_jobs(args, max(1, job_count(jobs) // share)), cwd=zlibdir)
 
-def build_cppunit(compiler, arch, cppunitdir):
-    if path.exists(path.join(cppunitdir, 'bin', 'DllPlugInTester.exe')) or path.exists(path.join(cppunitdir, 'lib', 'DllPlugInTester_dll.exe')):
-        print("cppunit already built.")
-        return
+    cached_build(cache, DependCache.key('zlib', git_revision(zlibdir), compiler, arch, args), zlibdir, build)
+
+
+def build_cppunit(compiler, arch, cppunitdir, cache=None, jobs=None, share=1):
+    """ Build cppunit in `cppunitdir`. Uses `1/share` of the parallel jobs, counted when every command starts (see `job_count`). """
     compiler, arch, vars = setup_environ(compiler, arch)
-    curdir = path.curdir
-    os.chdir(cppunitdir)
     if compiler == 'gcc':
         prefix = 'mingw32-' if os.name == 'nt' else ''
         outargs = [
@@ -168,43 +479,231 @@ def build_cppunit(compiler, arch, cppunitdir):
             rf'--libdir={win_to_posix(path.join(cppunitdir, "lib"))}',
             rf"--bindir={win_to_posix(path.join(cppunitdir, 'bin'))}"
             ]
-        for args in [
+        commands = [
             ['sh', './autogen.sh'],
             ['sh', './configure', f'MAKE={prefix}make'] + outargs + ['LDFLAGS=-static', '--disable-silent-rules', '--disable-dependency-tracking', '--disable-doxygen', '--disable-html-docs', '--disable-latex-docs'],
             [f'{prefix}make'],
             [f'{prefix}make', 'install']
-            ]:
-            run(args)
+            ]
     elif compiler == 'msvc':
-        args = ['cmd.exe', '/c', 'call', 'vcvarsall.bat', arch, '&&', 'msbuild', '/m', '/t:build', path.join(cppunitdir, 'src', 'cppunit', 'cppunit.vcxproj'), '/p:Configuration=Release', f'/p:Platform={vars["archName"]}', f'/p:PlatformToolset={vars["platformToolset" ]}']
-        run(args)
-    os.chdir(curdir)
+        commands = [
+            ['cmd.exe', '/c', 'call', 'vcvarsall.bat', arch, '&&', 'msbuild', '/m', '/t:build', path.join(cppunitdir, 'src', 'cppunit', 'cppunit.vcxproj'), '/p:Configuration=Release', f'/p:Platform={vars["archName"]}', f'/p:PlatformToolset={vars["platformToolset" ]}']
+            ]
+
+    def build():
+        for args in commands:
+            run(with_jobs(args, max(1, job_count(jobs) // share)), cwd=cppunitdir)
+
+    # key on relative paths, so the same entry serves every source tree
+    keyargs = [a.replace(win_to_posix(cppunitdir), '.').replace(cppunitdir, '.') for a in sum(commands, [])]
+    cached_build(cache, DependCache.key('cppunit', cppunit_version, compiler, arch, keyargs), cppunitdir, build)
+
+
+class HashingReader:
+    """ Read-only file wrapper that hashes, and optionally copies to `copy`, everything read through it. """
+    def __init__(self, fileobj, copy=None):
+        self.fileobj = fileobj
+        self.copy = copy
+        self.hash = hashlib.sha256()
+
+    def read(self, size=-1):
+        data = self.fileobj.read(size)
+        self.hash.update(data)
+        if self.copy is not None:
+            self.copy.write(data)
+        return data
+
+    def drain(self, chunk_size=1024*1024):
+        """ Read the remaining data (i.e. trailing padding ignored by `tarfile`). Returns the hex digest. """
+        while self.read(chunk_size):
+            pass
+        return self.hash.hexdigest()
+
+
+def extract_tgz_stream(fileobj, dstdir, rootdir, copy=None):
+    """
+    Extract the `rootdir` subtree of a `.tar.gz` stream into `dstdir`, in a single pass with constant memory.
+    Everything read is also written to `copy`, if specified.
+    Returns the SHA-256 of the whole stream.
+    """
+    import tarfile
+    reader = HashingReader(fileobj, copy)
+    with tarfile.open(fileobj=reader, mode='r|gz') as tf:
+        tf.extractall(dstdir, (m for m in tf if m.name.startswith(rootdir)), numeric_owner=True, filter='data')
+    return reader.drain()
+
+
+def resume_download(url, partfile, chunk_size=1024*1024):
+    """ Complete a partially downloaded file using a HTTP `Range` request. """
+    from urllib import request, error
+    offset = path.getsize(partfile)
+    print(f'resuming {url} at offset {offset}')
+    try:
+        with request.urlopen(request.Request(url, headers={'Range': f'bytes={offset}-'})) as http:
+            if http.status != 206:
+                offset = 0      # the server ignored the range, start over
+            with open(partfile, 'ab' if offset else 'wb') as fout:
+                shutil.copyfileobj(http, fout, chunk_size)
+    except error.HTTPError as e:
+        if e.code != 416:       # 416 Range Not Satisfiable: already complete
+            raise
+
+
+def download_cppunit(cppunitdir, version=cppunit_version, sha256=cppunit_sha256, url=None, cachedir=None):
+    """
+    Download and extract `cppunit` source code.
 
+    The archive is streamed straight into the extractor while being saved to `cachedir` and hashed,
+    so memory usage doesn't depend on the archive size. A cached archive is reused without network access,
+    an interrupted download is resumed. The archive must match the pinned `sha256` digest (`None` to skip the check).
 
-def download_cppunit(cppunitdir):
-    """ Download and extract `cppunit` source code. """
-    if not path.exists(cppunitdir):
-        version = '1.15.1'
-        url = f'https://dev-www.libreoffice.org/src/cppunit-{version}.tar.gz'
-        tgz = f'{cppunitdir}-{version}.tar.gz'
+    Arguments:
+    - url:       archive url. Default is `cppunit_url`
+    - cachedir:  downloaded archives directory. Default is the parent of `cppunitdir`
+    """
+    if path.exists(cppunitdir):
+        return
+    url = url or cppunit_url.format(version=version)
+    cachedir = cachedir or path.dirname(cppunitdir)
+    os.makedirs(cachedir, exist_ok=True)
+    tgz = path.join(cachedir, f'cppunit-{version}.tar.gz')
+    rootdir = f'cppunit-{version}'
+    tmpdir = f'{cppunitdir}.tmp-{os.getpid()}'
+    shutil.rmtree(tmpdir, ignore_errors=True)
+
+    if not path.exists(tgz) and path.exists(tgz + '.part'):
+        resume_download(url, tgz + '.part')
+        os.replace(tgz + '.part', tgz)      # verified below, while extracting
+
+    if path.exists(tgz):
+        print(f'extracting {tgz}')
+        with open(tgz, 'rb') as fin:
+            digest = extract_tgz_stream(fin, tmpdir, rootdir)
+    else:
         print(f'downloading {url}')
         from urllib import request
         with request.urlopen(url) as http:
-            with open(tgz, 'wb') as fout:
-                fout.write(http.read())
-        print(f'extracting {tgz}')
-        import tarfile
-        with tarfile.open(tgz) as tf:
-            memberlist = [m for m in tf.getmembers() if m.name.startswith(f'cppunit-{version}')]
-            tf.extractall(path.dirname(cppunitdir), memberlist, numeric_owner=True, filter='data')
-        print('rename "' + f'cppunit-{version}' + f'" -> "{cppunitdir}"')
-        os.rename(path.join(path.dirname(cppunitdir), f'cppunit-{version}'), cppunitdir)
+            with open(tgz + '.part', 'wb') as part:
+                digest = extract_tgz_stream(http, tmpdir, rootdir, copy=part)
+        os.replace(tgz + '.part', tgz)
+
+    if sha256 is not None and digest != sha256:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+        os.remove(tgz)
+        raise Exception(f'"{url}" sha256 mismatch: expected {sha256}, got {digest}')
+
+    print('rename "' + path.join(tmpdir, rootdir) + f'" -> "{cppunitdir}"')
+    os.rename(path.join(tmpdir, rootdir), cppunitdir)
+    shutil.rmtree(tmpdir, ignore_errors=True)
+
+
+def _run_task(name, func, args, logfile):
+    """ Process pool worker. Execute `func(*args)` with stdout/stderr redirected to `logfile`. Returns the wall time. """
+    start = time.perf_counter()
+    if os.name != 'nt' and os.getpgrp() != os.getpid():
+        import signal
+        os.setpgrp()    # the worker leads the group of the processes it starts
+        signal.signal(signal.SIGTERM, _terminate_task)
+    sys.stdout.flush()
+    sys.stderr.flush()
+    with open(logfile, 'w') as log:
+        os.dup2(log.fileno(), 1)    # child processes inherit the redirection
+        os.dup2(log.fileno(), 2)
+        try:
+            with nsis_trace.span(name, 'task'):
+                func(*args)
+        except BaseException:
+            import traceback
+            traceback.print_exc()
+            raise
+        finally:
+            sys.stdout.flush()
+            sys.stderr.flush()
+    return time.perf_counter() - start
+
+
+def _terminate_task(signum, frame):
+    """ SIGTERM handler of the pool workers (`Pool.terminate()`). Terminates the processes started by the task (make, configure, ...) as well. """
+    import signal
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    os.killpg(0, signal.SIGTERM)
+    os._exit(1)
+
+
+def kill_child_processes(pid):
+    """ Windows: kill the process trees started by a pool worker (make, msbuild, ...), `Pool.terminate()` only kills the worker. """
+    from subprocess import run as run_process, DEVNULL
+    children = run_process(['powershell', '-NoProfile', '-Command', f'(Get-CimInstance Win32_Process -Filter "ParentProcessId={pid}").ProcessId'],
+                           stdout=PIPE, stderr=DEVNULL, text=True).stdout.split()
+    for child in children:
+        run_process(['taskkill', '/F', '/T', '/PID', child], stdout=DEVNULL, stderr=DEVNULL)
+
+
+def run_task_graph(tasks, logdir, jobs=None):
+    """
+    Execute a graph of tasks in a process pool.
 
+    Arguments:
+    - tasks:   dictionary `{name: (func, args, deps)}`. A task starts after all its `deps` succeeded
+    - logdir:  directory that receives the output of every task, `{logdir}/{name}.log`
+    - jobs:    maximum number of concurrent tasks. Default is the number of tasks
 
-def build_nsis_distro(compiler, arch, build_number, zlibdir, cppunitdir=None, nsislog=True, nsismaxstrlen=4096, actions=['test', 'dist']):
+    Fails fast: the first failed task terminates the pool, along with the processes started by the tasks still running,
+    and raises an exception after printing the output of the failed task and of the tasks still running.
+
+    Returns:
+      Dictionary `{name: seconds}` with the wall time of every task
+    """
+    import multiprocessing, queue
+    for name, (func, args, deps) in tasks.items():
+        for dep in deps:
+            if dep not in tasks: raise Exception(f'task "{name}" depends on unknown task "{dep}"')
+
+    def print_log(name, status):
+        print(f"-- [{name}] {status}")
+        with open(path.join(logdir, f"{name}.log")) as fin:
+            for line in fin:
+                print(f"[{name}] {line}", end='')
+
+    os.makedirs(logdir, exist_ok=True)
+    done = queue.Queue()
+    pending = dict(tasks)
+    running = set()
+    timings = {}
+    with multiprocessing.Pool(min(jobs or len(tasks), len(tasks)) or 1) as pool:
+        while pending or running:
+            for name, (func, args, deps) in list(pending.items()):
+                if all(dep in timings for dep in deps):
+                    del pending[name]
+                    running.add(name)
+                    print(f"-- [{name}] started")
+                    pool.apply_async(_run_task, (name, func, args, path.join(logdir, f"{name}.log")),
+                                     callback=lambda seconds, name=name: done.put((name, seconds, None)),
+                                     error_callback=lambda error, name=name: done.put((name, None, error)))
+            if not running:
+                raise Exception(f"task graph has a dependency cycle: {list(pending)}")
+            name, seconds, error = done.get()
+            running.remove(name)
+            if error is not None:
+                if os.name == 'nt':
+                    for worker in multiprocessing.active_children():
+                        kill_child_processes(worker.pid)
+                pool.terminate()    # posix workers forward the termination, see _terminate_task()
+                print_log(name, f"failed: {error!r}")
+                for other in running:
+                    print_log(other, "terminated")
+                raise Exception(f'task "{name}" failed. See "{path.join(logdir, name + ".log")}"') from error
+            timings[name] = seconds
+            print_log(name, f"finished in {seconds:.1f}s")
+    return timings
+
+
+def build_nsis_distro(compiler, arch, build_number, zlibdir, cppunitdir=None, nsislog=True, nsismaxstrlen=4096, actions=['test', 'dist'], jobs=None, build_root=None, build_cache=None, build_cache_size=2048):
     """
     Build a NSIS distribution package. 
     `zlib` and `cppunit` must be built as well.
+    `build_root` (relative to the source tree) receives all SCons outputs, see `BUILD_ROOT` in SConstruct.
+    `build_cache` caches the built objects, it can be shared by all architectures (MiB `build_cache_size`), see `CACHE_DIR` in SConstruct.
     """
     compiler, arch, vars = setup_environ(compiler, arch)
 
@@ -229,6 +728,12 @@ def build_nsis_distro(compiler, arch, build_number, zlibdir, cppunitdir=None, ns
             f'NSIS_CONFIG_LOG_TIMESTAMP={"Yes" if nsislog else "No"}',
             f'NSIS_MAX_STRLEN={nsismaxstrlen}']
 
+    if build_root:
+        args += [f'BUILD_ROOT={build_root}']
+
+    if build_cache:
+        args += [f'CACHE_DIR={path.abspath(build_cache)}', f'CACHE_SIZE={build_cache_size}']
+
     if compiler == 'gcc' and os.name == 'nt':
         args += ['TOOLSET=gcc,gnulink,mingw']   # use mingw toolset in Windows
 
@@ -246,7 +751,7 @@ def build_nsis_distro(compiler, arch, build_number, zlibdir, cppunitdir=None, ns
 
     args += actions
 
-    run(args)
+    run(with_jobs(args, job_count(jobs)))
 
 
 if __name__ == '__main__':
@@ -259,29 +764,69 @@ if __name__ == '__main__':
     parser.add_argument("-l", "--nsis-log", type=lambda x: (str(x).lower() in ['true','1', 'yes']), default=True, help='Enable NSIS logging. See LogSet and LogText')
     parser.add_argument("-s", "--nsis-max-strlen", type=int, default=4096, help='Sets NSIS maximum string length. See NSIS_MAX_STRLEN')
     parser.add_argument("-t", "--tests", type=lambda x: (str(x).lower() in ['true','1', 'yes']), default=True, help='Build and run NSIS unit tests')
+    parser.add_argument("--depend-cache", type=str, default=os.environ.get('NSIS_DEPEND_CACHE'), help='Prebuilt dependencies (zlib, cppunit) cache directory. Default is ".depend/cache". Empty string disables the cache')
+    parser.add_argument("--depend-cache-size", type=int, default=2048, help='Maximum dependencies cache size, in MiB')
+    parser.add_argument("--build-cache", type=str, default=os.environ.get('NSIS_BUILD_CACHE'), help='Built objects cache directory (SCons CACHE_DIR), can be shared by all architectures. Default is ".depend/build-cache". Empty string disables the cache')
+    parser.add_argument("--build-cache-size", type=int, default=2048, help='Maximum built objects cache size, in MiB')
+    parser.add_argument("--zlib-revision", type=str, default=zlib_revision, help=f'Pinned zlib commit or tag. Empty string tracks the default branch. Default is "{zlib_revision}"')
+    parser.add_argument("--git-cache", type=str, default=os.environ.get('NSIS_GIT_CACHE'), help='Shared bare repository for git objects of all checkouts. Default is ".depend/git"')
+    parser.add_argument("--download-cache", type=str, default=os.environ.get('NSIS_DOWNLOAD_CACHE'), help='Downloaded archives (cppunit) directory. Default is ".depend/downloads"')
+    parser.add_argument("--cppunit-url", type=str, default=os.environ.get('NSIS_CPPUNIT_URL'), help=f'cppunit source archive url. Default is "{cppunit_url}"')
+    parser.add_argument("-o", "--build-root", type=str, default=None, help='Build out-of-tree. All outputs (dependencies, objects, dist directories) go to this directory, relative to the source tree')
+    parser.add_argument("--trace", type=str, default=None, help='Build trace file (Chrome trace format). Default is ".trace.json" in the build root. Ignored if NSIS_TRACE_FILE is already set')
+    parser.add_argument("-j", "--jobs", type=int, default=None, help='Number of parallel jobs. Default is the number of available cores, or the share assigned by nsis_build_local.py')
     args = parser.parse_args()
 
     separator = ''
 
-    workdir = path.dirname(__file__)
+    workdir = path.dirname(path.abspath(__file__))
     os.makedirs(workdir, exist_ok=True)
     print(f"workdir = {workdir}")
 
-    zlibdir = path.join(workdir, '.depend', 'zlib')
-    print(separator)
-    git_checkout('https://github.com/madler/zlib.git', zlibdir)
-    print(separator)
-    build_zlib(args.compiler, args.arch, zlibdir)
+    if nsis_trace.start_trace(args.trace or path.join(workdir, args.build_root or '', '.trace.json')):
+        import atexit
+        atexit.register(nsis_trace.finish_trace)     # write the trace even if the build fails
+    print(f"trace = {nsis_trace.trace_file()}")
+
+    if args.depend_cache is None:
+        args.depend_cache = path.join(workdir, '.depend', 'cache')
+    cache = DependCache(args.depend_cache, args.depend_cache_size*1024*1024) if args.depend_cache else None
+    if cache is not None:
+        print(f"depend cache = {cache.cachedir}")
+
+    if args.build_cache is None:
+        args.build_cache = path.join(workdir, '.depend', 'build-cache')
+    if args.build_cache:
+        print(f"build cache = {args.build_cache}")
+
+    # fail early if the toolchain is missing; the dependency tasks and the final build reuse the result
+    setup_environ(args.compiler, args.arch)
+
+    # out-of-tree builds get their own dependencies, the cache is shared
+    dependdir = path.join(workdir, args.build_root or '', '.depend')
+
+    # zlib and cppunit are independent, build them concurrently and split the job budget between them
+    depshare = 2 if args.tests else 1
+
+    zlibdir = path.join(dependdir, 'zlib')
+    tasks = {
+        'zlib-checkout': (git_checkout, [zlib_url, zlibdir, 1, args.zlib_revision or None, args.git_cache or path.join(workdir, '.depend', 'git')], []),
+        'zlib-build': (build_zlib, [args.compiler, args.arch, zlibdir, cache, args.jobs, depshare], ['zlib-checkout']),
+    }
 
     cppunitdir = None
     if args.tests:
-        cppunitdir = path.join(workdir, '.depend', 'cppunit')
-        print(separator)
+        cppunitdir = path.join(dependdir, 'cppunit')
         # git_checkout('git://anongit.freedesktop.org/git/libreoffice/cppunit', cppunitdir)   # git server is unreliable lately
-        download_cppunit(cppunitdir)
-        print(separator)
-        build_cppunit(args.compiler, args.arch, cppunitdir)
+        downloaddir = args.download_cache or path.join(workdir, '.depend', 'downloads')
+        tasks['cppunit-download'] = (download_cppunit, [cppunitdir, cppunit_version, cppunit_sha256, args.cppunit_url, downloaddir], [])
+        tasks['cppunit-build'] = (build_cppunit, [args.compiler, args.arch, cppunitdir, cache, args.jobs, depshare], ['cppunit-download'])
+
+    print(separator)
+    timings = run_task_graph(tasks, path.join(dependdir, 'logs'))
+    for name, seconds in timings.items():
+        print(f"-- {name}: {seconds:.1f}s")
 
     print(separator)
     actions = ['test', 'dist'] if args.tests else ['dist']
-    build_nsis_distro(args.compiler, args.arch, args.build_number, zlibdir, cppunitdir, args.nsis_log, args.nsis_max_strlen, actions)
+    build_nsis_distro(args.compiler, args.arch, args.build_number, zlibdir, cppunitdir, args.nsis_log, args.nsis_max_strlen, actions, args.jobs, args.build_root, args.build_cache, args.build_cache_size)
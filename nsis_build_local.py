@@ -1,54 +1,217 @@
 from glob import glob
 from os import path
-import datetime, os, sys, shutil
-from subprocess import Popen
-from threading import Thread
+import datetime, os, sys, shutil, re, json
+from threading import Lock
 
 from nsis_build import *
 from nsis_package import *
 
-def path_match_re_list(filepath, relist=[]):
-    """ Match a file path against a list of regular expressions. Returns `True` if a match is found. """
-    for expr in relist:
-        if re.match(expr, filepath) is not None:
-            return True
-    return False
+def compile_re_list(relist=[]):
+    """ Compile a list of regular expressions into a single matcher. """
+    return re.compile('|'.join(f'(?:{expr})' for expr in relist) or r'(?!)')
 
-def copy_sources(srcdir, dstdir, verbose=False):
-    """ Copy project source files to another directory. """
-    incl = [
+def copy_sources(srcdir, dstdir, verbose=False, mode='reflink', verify=False):
+    """
+    Synchronize project source files to another directory.
+
+    A manifest (`{dstdir}/.nsis-sync.json`) records the source and destination `(size, mtime_ns)` of every synchronized file.
+    Only new or changed files are cloned (see `clone_file` for `mode`), files that no longer exist upstream are deleted.
+    With `verify=True`, files whose timestamp changed are also hashed and skipped if their content is the same.
+
+    Returns:
+      Dictionary `{"copy": int, "reflink": int, "hardlink": int, "unchanged": int, "deleted": int}`
+    """
+    incl = compile_re_list([
         r'Contrib.+', r'Docs.+', r'Examples.+', r'Include.+', r'Menu.+', r'SCons.+', r'Scripts.+', r'Source.+',
         r'^nsis_.+\.py$', r'^nsisconf\.nsh$', r'^SCons\S+$', r'^COMPILE$', r'^COPYING$', r'^INSTALL$', r'^README.*$'
-        ]
-    excl = [r'Contrib\\NScurl\\github.*']
-
-    for file in glob('**', root_dir=srcdir, recursive=True):
-        if not path.isfile(file) or not path_match_re_list(file, incl) or path_match_re_list(file, excl):
-            continue
-        srcfile = path.join(srcdir, file)
-        dstfile = path.join(dstdir, file)
-        if path.exists(dstfile) and os.stat(srcfile).st_mtime == os.stat(dstdir).st_mtime:
-            continue
-        if verbose:
-            print(f"-- copy( {srcfile} --> {dstfile}")
+        ])
+    excl = compile_re_list([r'Contrib/NScurl/github.*'])
+
+    manifest_file = path.join(dstdir, '.nsis-sync.json')
+    try:
+        with open(manifest_file) as fin:
+            manifest = json.load(fin)
+    except (OSError, ValueError):
+        manifest = {}
+
+    stats = {'copy': 0, 'reflink': 0, 'hardlink': 0, 'unchanged': 0, 'deleted': 0}
+    synced = {}
+    for root, dirs, files in os.walk(srcdir):
+        reldir = path.relpath(root, srcdir).replace(os.sep, '/')
+        reldir = '' if reldir == '.' else reldir + '/'
+        # skip hidden entries, and top level directories that can't contain a match (i.e. build-local-*)
+        dirs[:] = [d for d in dirs if not d.startswith('.') and (reldir or incl.match(d + '/'))]
+        for file in files:
+            relfile = reldir + file
+            if file.startswith('.') or not incl.match(relfile) or excl.match(relfile):
+                continue
+            srcfile = path.join(srcdir, relfile)
+            dstfile = path.join(dstdir, relfile)
+            srcstat = os.stat(srcfile)
+            dststat = os.stat(dstfile) if path.exists(dstfile) else None
+            entry = manifest.get(relfile)
+            if entry is not None and dststat is not None and entry[2:4] == [dststat.st_size, dststat.st_mtime_ns]:
+                if entry[0:2] == [srcstat.st_size, srcstat.st_mtime_ns]:
+                    synced[relfile] = entry
+                    stats['unchanged'] += 1
+                    continue
+                if verify and entry[4] is not None and entry[0] == srcstat.st_size and entry[4] == file_digest(srcfile):
+                    synced[relfile] = [srcstat.st_size, srcstat.st_mtime_ns] + entry[2:]
+                    stats['unchanged'] += 1
+                    continue
+            if verbose:
+                print(f"-- copy( {srcfile} --> {dstfile} )")
+            if dststat is not None:
+                os.remove(dstfile)
+            else:
+                os.makedirs(path.dirname(dstfile), exist_ok=True)
+            stats[clone_file(srcfile, dstfile, mode)] += 1
+            dststat = os.stat(dstfile)
+            synced[relfile] = [srcstat.st_size, srcstat.st_mtime_ns, dststat.st_size, dststat.st_mtime_ns, file_digest(srcfile) if verify else None]
+
+    # delete files that no longer exist upstream
+    for relfile in manifest.keys() - synced.keys():
+        dstfile = path.join(dstdir, relfile)
         if path.exists(dstfile):
+            if verbose:
+                print(f"-- delete( {dstfile} )")
             os.remove(dstfile)
-        else:
-            os.makedirs(path.dirname(dstfile), exist_ok=True)
-        shutil.copy2(srcfile, dstfile)
+            stats['deleted'] += 1
+            parent = path.dirname(dstfile)
+            while path.abspath(parent) != path.abspath(dstdir) and not os.listdir(parent):
+                os.rmdir(parent)    # prune empty parent directories
+                parent = path.dirname(parent)
+
+    os.makedirs(dstdir, exist_ok=True)
+    with open(manifest_file + '.tmp', 'w') as fout:
+        json.dump(synced, fout)
+    os.replace(manifest_file + '.tmp', manifest_file)
+    print(f"-- copy_sources( {srcdir} --> {dstdir} ): {stats}")
+    return stats
+
+class JobBudget:
+    """
+    Share `total` parallel jobs fairly between concurrent builds.
+    Every running build gets its share in a file (see `nsis_build.job_count`), re-read before each build step.
+    When a build finishes, the remaining builds are rebalanced to use its cores.
+    """
+    def __init__(self, total):
+        self.total = total
+        self.files = []
+        self.lock = Lock()
+
+    def acquire(self, jobsfile):
+        with self.lock:
+            self.files.append(jobsfile)
+            self._rebalance()
+
+    def release(self, jobsfile):
+        with self.lock:
+            self.files.remove(jobsfile)
+            self._rebalance()
+
+    def _rebalance(self):
+        for i, jobsfile in enumerate(self.files):
+            share = self.total // len(self.files) + (1 if i < self.total % len(self.files) else 0)
+            with open(jobsfile, 'w') as fout:
+                fout.write(str(max(1, share)))
+            print(f"-- {jobsfile}: {max(1, share)} jobs")
 
-error_count = 0
+async def pump_stream(stream, label, out, log, tail, chunk_size=65536):
+    """
+    Copy a subprocess pipe line by line to `out` (prefixed with `[label]`), to the `log` file and to the `tail` ring buffer.
+    Reads in chunks, so neither the pipe nor a single endless line can buffer unbounded output.
+    """
+    def emit(line):
+        text = line.decode('utf-8', errors='replace').rstrip('\r')
+        out.write(f"[{label}] {text}\n")
+        log.write(text + '\n')
+        tail.append(text)
 
-def build_thread(nsisdir, distrodir, compiler, arch, build_number=0, nsislog=True, nsismaxstrlen=4096, tests=True, new_console=True):
-    # clone NSIS source code from current directory to {distrodir}
-    copy_sources(nsisdir, distrodir)
+    partial = b''
+    while chunk := await stream.read(chunk_size):
+        lines = (partial + chunk).split(b'\n')
+        partial = lines.pop()
+        if len(partial) >= chunk_size:
+            lines.append(partial)
+            partial = b''
+        for line in lines:
+            emit(line)
+        out.flush()
+    if partial:
+        emit(partial)
+    out.flush()
+    log.flush()
+
+async def run_streamed(label, args, logfile, tail_lines=200, **kwargs):
+    """
+    Execute a subprocess without blocking the event loop.
+    Its stdout/stderr are streamed to the console with a `[label]` prefix and tee-ed to `logfile`.
+    On failure, the last `tail_lines` lines are printed again.
+    Returns the exit code.
+    """
+    import asyncio, collections, time
+    from nsis_trace import record
+    tail = collections.deque(maxlen=tail_lines)
+    start = time.time()
+    with open(logfile, 'w', encoding='utf-8') as log:
+        process = await asyncio.create_subprocess_exec(*args, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE, **kwargs)
+        await asyncio.gather(pump_stream(process.stdout, label, sys.stdout, log, tail),
+                             pump_stream(process.stderr, label, sys.stderr, log, tail))
+        exitcode = await process.wait()
+    record(label, 'run', start, time.time() - start, command=[str(a) for a in args], cwd=kwargs.get('cwd'), exitcode=exitcode, log=logfile)
+    if exitcode != 0:
+        print(f"-- [{label}] exit code {exitcode}. Last {len(tail)} lines (full log: {logfile}):")
+        for line in tail:
+            print(f"[{label}] {line}")
+    return exitcode
+
+async def build_arch(nsisdir, distrodir, compiler, arch, build_number=0, nsislog=True, nsismaxstrlen=4096, tests=True, budget=None, out_of_tree=False):
+    """ Build one architecture with `nsis_build.py`. Returns the exit code. """
+    import asyncio
+    if out_of_tree:
+        # build from {nsisdir}, all outputs go to {distrodir}
+        script, cwd = path.join(nsisdir, 'nsis_build.py'), nsisdir
+        extra_args = [f'--build-root={path.relpath(distrodir, nsisdir)}']
+    else:
+        # clone NSIS source code from current directory to {distrodir}
+        await asyncio.get_running_loop().run_in_executor(None, copy_sources, nsisdir, distrodir)
+        script, cwd = path.join(nsisdir, distrodir, 'nsis_build.py'), distrodir
+        extra_args = []
     # Run 'nsis_build.py'
-    args = [sys.executable, path.join(nsisdir, distrodir, 'nsis_build.py'), f'-a={arch}', f'-c={compiler}', f'-b={build_number}', f'-l={nsislog}', f'-s={nsismaxstrlen}', f'-t={tests}']
-    exitcode = Popen(args, cwd=distrodir, creationflags=(subprocess.CREATE_NEW_CONSOLE if new_console else 0)).wait()
+    os.makedirs(distrodir, exist_ok=True)
+    jobsfile = path.join(path.abspath(distrodir), '.nsis-jobs')
+    if budget is not None:
+        budget.acquire(jobsfile)
+    env = dict(os.environ, NSIS_TOOLCHAIN_CACHE=os.environ.get('NSIS_TOOLCHAIN_CACHE') or path.join(path.abspath(nsisdir), '.depend', 'toolchain.json'))   # toolchain discovered once for all architectures
+    if budget is not None:
+        env['NSIS_JOBS_FILE'] = jobsfile
+    args = [sys.executable, '-u', script, f'-a={arch}', f'-c={compiler}', f'-b={build_number}', f'-l={nsislog}', f'-s={nsismaxstrlen}', f'-t={tests}',
+            f'--depend-cache={path.join(path.abspath(nsisdir), ".depend", "cache")}',       # prebuilt dependencies shared by all architectures
+            f'--build-cache={path.join(path.abspath(nsisdir), ".depend", "build-cache")}',  # built objects shared by all architectures
+            f'--git-cache={path.join(path.abspath(nsisdir), ".depend", "git")}',            # git objects shared by all architectures
+            f'--download-cache={path.join(path.abspath(nsisdir), ".depend", "downloads")}'] + extra_args
+    try:
+        exitcode = await run_streamed(arch, args, path.join(distrodir, 'build.log'), cwd=cwd, env=env)
+    finally:
+        if budget is not None:
+            budget.release(jobsfile)
     print(f"-- {args} returned {exitcode}")
-    if exitcode != 0:
-        global error_count
-        error_count += 1
+    return exitcode
+
+async def build_archs(builds, parallel=True):
+    """ Run `build_arch` coroutines, concurrently or one after another (stopping at the first failure). Returns the exit codes. """
+    import asyncio
+    if parallel:
+        return await asyncio.gather(*builds)
+    exitcodes = []
+    for build in builds:
+        exitcodes.append(await build)
+        if exitcodes[-1] != 0:
+            for pending in builds[len(exitcodes):]:
+                pending.close()     # never awaited
+            break
+    return exitcodes
 
 if __name__ == '__main__':
 
@@ -58,43 +221,43 @@ if __name__ == '__main__':
     parser.add_argument("-c", "--compiler", type=str, default='gcc', choices=['gcc', 'msvc'], help="Compiler (gcc|msvc)")
     parser.add_argument("-l", "--nsis-log", type=lambda x: (str(x).lower() in ['true','1', 'yes']), default=True, help='Enable NSIS logging. See LogSet and LogText')
     parser.add_argument("-s", "--nsis-max-strlen", type=int, default=4096, help='Sets NSIS maximum string length. See NSIS_MAX_STRLEN')
-    parser.add_argument("-p", "--parallel", type=lambda x: (str(x).lower() in ['true','1', 'yes']), default=True, help='Build x86 and amd64 in parallel. Disable to investigate build errors')
+    parser.add_argument("-p", "--parallel", type=lambda x: (str(x).lower() in ['true','1', 'yes']), default=True, help='Build x86 and amd64 in parallel. Output lines are prefixed with [x86]/[amd64]. Disable to investigate build errors')
     parser.add_argument("-t", "--tests", type=lambda x: (str(x).lower() in ['true','1', 'yes']), default=True, help='Build and run NSIS unit tests')
     parser.add_argument("-v", "--verbose-level", type=int, default=3, help='makensis.exe verbosity level')
+    parser.add_argument("-o", "--out-of-tree", type=lambda x: (str(x).lower() in ['true','1', 'yes']), default=False, help='Build all architectures from this source tree into build-local-<compiler>-<arch> directories, instead of building cloned source trees')
+    parser.add_argument("-j", "--jobs", type=int, default=cpu_count(), help='Total number of parallel jobs, shared by the concurrent architecture builds. Default is the number of available cores')
     args = parser.parse_args()
 
     separator = '\n--------------------------------------------------------------------------------\n'
 
-    nsisdir = path.dirname(__file__)
+    nsisdir = path.dirname(path.abspath(__file__))
     distro_x86_dir   = path.join(nsisdir, f'build-local-{args.compiler}-x86')
     distro_amd64_dir = path.join(nsisdir, f'build-local-{args.compiler}-amd64')
 
-    threads = [
-        Thread(target=build_thread, args=[nsisdir, distro_x86_dir,   args.compiler, 'x86',   args.build_number, args.nsis_log, args.nsis_max_strlen, args.tests, args.parallel]),
-        Thread(target=build_thread, args=[nsisdir, distro_amd64_dir, args.compiler, 'amd64', args.build_number, args.nsis_log, args.nsis_max_strlen, args.tests, args.parallel]),
-    ]
+    budget = JobBudget(args.jobs)
+
+    # a single trace for both architectures and the installers
+    import nsis_trace
+    if nsis_trace.start_trace(path.join(nsisdir, f'.trace-local-{args.compiler}.json')):
+        import atexit
+        atexit.register(nsis_trace.finish_trace)
 
     buildStart = datetime.datetime.now()
     print(f'\n-- build started at {buildStart}\n')
 
-    if args.parallel:
-        for th in threads:
-            th.start()
-        for th in threads:
-            th.join()
-    else:
-        for th in threads:
-            th.start()
-            th.join()
-            if error_count > 0:
-                break
+    import asyncio
+    exitcodes = asyncio.run(build_archs([
+        build_arch(nsisdir, distro_x86_dir,   args.compiler, 'x86',   args.build_number, args.nsis_log, args.nsis_max_strlen, args.tests, budget, args.out_of_tree),
+        build_arch(nsisdir, distro_amd64_dir, args.compiler, 'amd64', args.build_number, args.nsis_log, args.nsis_max_strlen, args.tests, budget, args.out_of_tree),
+        ], args.parallel))
+    error_count = sum(1 for exitcode in exitcodes if exitcode != 0)
 
     buildEnd = datetime.datetime.now()
     print(f'\n-- build ended at {buildEnd} (+{buildEnd - buildStart})\n')
 
     if error_count > 0:
-        print(f"{error_count}/{len(threads)} architectures failed to build")
-        print("Tip: use --parallel=false argument to build sequentially and print the output to the main console")
+        print(f"{error_count}/2 architectures failed to build. Full logs: build-local-{args.compiler}-<arch>/build.log")
+        print("Tip: use --parallel=false argument to build sequentially")
         exit(error_count)
 
     instdist_x86_dir   = path.join(distro_x86_dir,   '.instdist')
@@ -104,9 +267,9 @@ if __name__ == '__main__':
     merge_nsis_distros(instdist_x86_dir, instdist_amd64_dir)
 
     print(separator)
-    build_nsis_installer(instdist_x86_dir,   'x86',   build_number=args.build_number, verbose_level=args.verbose_level)
-    print(separator)
-    build_nsis_installer(instdist_amd64_dir, 'amd64', build_number=args.build_number, verbose_level=args.verbose_level)
+    build_nsis_installers([(instdist_x86_dir, 'x86', None), (instdist_amd64_dir, 'amd64', None)],
+                          build_number=args.build_number, verbose_level=args.verbose_level, parallel=args.parallel,
+                          manifest=PackageManifest(path.join(nsisdir, f'.nsis-package-local-{args.compiler}.json')))     # skip unchanged installers
 
     print(separator)
     allEnd = datetime.datetime.now()
@@ -12,5 +12,9 @@ for /d %%d in (build-local*) do rmdir /s /q "%%~d"
 
 del /q .sconsign.dblite
 del /q config.log
+del /q .sconf_cache.json
+del /q .trace*.json
+del /q test-scripts.*
+del /q .nsis-package*.json
 
 REM pause
\ No newline at end of file
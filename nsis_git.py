@@ -0,0 +1,253 @@
+import heapq
+import mmap
+import os
+import re
+import struct
+import zlib
+from glob import glob
+from os import path
+
+# Minimal read-only git repository reader.
+# Answers the questions the build scripts ask (current branch, HEAD commit, commit history) without spawning `git`.
+# Unsupported layouts (i.e. sha256 repositories, reftable) raise `ValueError`; callers fall back to the git CLI.
+
+class GitRepository:
+    OBJ_COMMIT, OBJ_TREE, OBJ_BLOB, OBJ_TAG, OBJ_OFS_DELTA, OBJ_REF_DELTA = 1, 2, 3, 4, 6, 7
+    type_names = {1: 'commit', 2: 'tree', 3: 'blob', 4: 'tag'}
+
+    def __init__(self, workdir):
+        gitdir = path.join(workdir, '.git')
+        if path.isfile(gitdir):
+            # worktrees and submodules: "gitdir: <path>"
+            with open(gitdir) as fin:
+                line = fin.read().strip()
+            if not line.startswith('gitdir:'):
+                raise ValueError(f'unsupported .git file {gitdir}')
+            gitdir = path.normpath(path.join(workdir, line[len('gitdir:'):].strip()))
+        if not path.isfile(path.join(gitdir, 'HEAD')):
+            raise ValueError(f'not a git repository: {workdir}')
+        self.gitdir = gitdir
+        self.commondir = gitdir
+        if path.isfile(commondir := path.join(gitdir, 'commondir')):
+            with open(commondir) as fin:
+                self.commondir = path.normpath(path.join(gitdir, fin.read().strip()))
+        with open(path.join(self.commondir, 'config')) as fin:
+            config = fin.read()
+        if re.search(r'^\s*(objectformat|refstorage)\s*=', config, re.MULTILINE | re.IGNORECASE):
+            raise ValueError('unsupported repository format')
+        self.objectdirs = self._objectdirs(path.join(self.commondir, 'objects'))
+        self.packs = None
+        self.packed_refs = None
+
+    def _objectdirs(self, objectdir, depth=0):
+        dirs = [objectdir]
+        if depth < 5 and path.isfile(alternates := path.join(objectdir, 'info', 'alternates')):
+            with open(alternates) as fin:
+                for line in fin.read().splitlines():
+                    if line and not line.startswith('#'):
+                        dirs += self._objectdirs(path.normpath(path.join(objectdir, line)), depth + 1)
+        return dirs
+
+    # ----- refs -----
+
+    def head(self):
+        """ Returns `(commit, branch)`. `branch` is `HEAD` if detached, like `git rev-parse --abbrev-ref HEAD`. """
+        with open(path.join(self.gitdir, 'HEAD')) as fin:
+            head = fin.read().strip()
+        if head.startswith('ref:'):
+            ref = head[len('ref:'):].strip()
+            return self.resolve(ref), ref[len('refs/heads/'):] if ref.startswith('refs/heads/') else ref
+        return head, 'HEAD'
+
+    def resolve(self, ref):
+        """ Commit id of a full ref name (i.e. `refs/heads/master`). """
+        for _ in range(10):
+            for dir in [self.gitdir, self.commondir]:
+                if path.isfile(file := path.join(dir, ref)):
+                    with open(file) as fin:
+                        value = fin.read().strip()
+                    break
+            else:
+                value = self._packed_refs().get(ref)
+                if value is None:
+                    raise ValueError(f'unknown ref {ref}')
+            if not value.startswith('ref:'):
+                return value
+            ref = value[len('ref:'):].strip()
+        raise ValueError(f'ref loop {ref}')
+
+    def _packed_refs(self):
+        if self.packed_refs is None:
+            self.packed_refs = {}
+            if path.isfile(file := path.join(self.commondir, 'packed-refs')):
+                with open(file) as fin:
+                    for line in fin.read().splitlines():
+                        if line and line[0] not in '#^':
+                            sha, ref = line.split(' ', 1)
+                            self.packed_refs[ref] = sha
+        return self.packed_refs
+
+    # ----- objects -----
+
+    def read(self, sha):
+        """ Returns `(type_name, data)` of an object. Raises `KeyError` if the object is missing. """
+        for dir in self.objectdirs:
+            if path.isfile(file := path.join(dir, sha[:2], sha[2:])):
+                with open(file, 'rb') as fin:
+                    raw = zlib.decompress(fin.read())
+                header, data = raw.split(b'\0', 1)
+                return header.split(b' ')[0].decode(), data
+        for pack in self._packs():
+            if (offset := pack.find(sha)) is not None:
+                type, data = pack.read(offset, self)
+                return self.type_names[type], data
+        raise KeyError(sha)
+
+    def _packs(self):
+        if self.packs is None:
+            self.packs = [GitPack(idx) for dir in self.objectdirs for idx in sorted(glob(path.join(dir, 'pack', '*.idx')))]
+        return self.packs
+
+    def commit(self, sha):
+        """ Returns `(parents, commit_time, message)`. """
+        type, data = self.read(sha)
+        if type != 'commit':
+            raise ValueError(f'{sha} is a {type}')
+        header, _, message = data.partition(b'\n\n')
+        parents, time = [], 0
+        for line in header.split(b'\n'):
+            if line.startswith(b'parent '):
+                parents.append(line[7:].decode())
+            elif line.startswith(b'committer '):
+                time = int(line.rsplit(b' ', 2)[1])
+        return parents, time, message.decode('utf-8', errors='replace')
+
+    def log(self, sha):
+        """ Walk the history in `git log` order (newest commit first). Yields `(sha, message)`. Stops at shallow boundaries. """
+        seen = {sha}
+        parents, time, message = self.commit(sha)
+        queue = [(-time, sha, parents, message)]
+        while queue:
+            _, sha, parents, message = heapq.heappop(queue)
+            yield sha, message
+            for parent in parents:
+                if parent not in seen:
+                    seen.add(parent)
+                    try:
+                        grandparents, time, message = self.commit(parent)
+                    except KeyError:
+                        continue    # shallow clone
+                    heapq.heappush(queue, (-time, parent, grandparents, message))
+
+
+class GitPack:
+    """ Packfile reader. Objects are located through the version 2 `.idx` fan-out table. """
+    def __init__(self, idxfile):
+        with open(idxfile, 'rb') as fin:
+            self.idx = fin.read()
+        if self.idx[:8] != b'\377tOc\0\0\0\2':
+            raise ValueError(f'unsupported pack index {idxfile}')
+        self.count = struct.unpack_from('>I', self.idx, 8 + 255*4)[0]
+        self.packfile = idxfile[:-len('.idx')] + '.pack'
+        self.pack = None
+        self.cache = {}
+
+    def find(self, sha):
+        """ Offset of object `sha` in the packfile, or `None`. """
+        binsha = bytes.fromhex(sha)
+        first = binsha[0]
+        lo = struct.unpack_from('>I', self.idx, 8 + (first-1)*4)[0] if first else 0
+        hi = struct.unpack_from('>I', self.idx, 8 + first*4)[0]
+        names = 8 + 256*4
+        while lo < hi:
+            mid = (lo + hi) // 2
+            name = self.idx[names + mid*20 : names + mid*20 + 20]
+            if name < binsha: lo = mid + 1
+            elif name > binsha: hi = mid
+            else:
+                offsets = names + self.count*20 + self.count*4
+                offset = struct.unpack_from('>I', self.idx, offsets + mid*4)[0]
+                if offset & 0x80000000:
+                    offset = struct.unpack_from('>Q', self.idx, offsets + self.count*4 + (offset & 0x7fffffff)*8)[0]
+                return offset
+        return None
+
+    def read(self, offset, repo):
+        """ Returns `(type, data)` of the object at `offset`, with deltas applied. """
+        if offset in self.cache:
+            return self.cache[offset]
+        if self.pack is None:
+            with open(self.packfile, 'rb') as fin:
+                self.pack = memoryview(mmap.mmap(fin.fileno(), 0, access=mmap.ACCESS_READ))
+        pack, pos = self.pack, offset
+        byte = pack[pos]; pos += 1
+        type = (byte >> 4) & 7
+        while byte & 0x80:      # inflated size, not needed
+            byte = pack[pos]; pos += 1
+        source = None
+        if type == GitRepository.OBJ_OFS_DELTA:
+            byte = pack[pos]; pos += 1
+            base = byte & 0x7f
+            while byte & 0x80:
+                byte = pack[pos]; pos += 1
+                base = ((base + 1) << 7) | (byte & 0x7f)
+            type, source = self.read(offset - base, repo)
+        elif type == GitRepository.OBJ_REF_DELTA:
+            basesha = pack[pos:pos+20].hex(); pos += 20
+            if (baseoffset := self.find(basesha)) is not None:
+                type, source = self.read(baseoffset, repo)
+            else:
+                typename, source = repo.read(basesha)
+                type = {name: t for t, name in GitRepository.type_names.items()}[typename]
+        data = self.inflate(pos)
+        if source is not None:
+            data = self.apply_delta(source, data)
+        if len(self.cache) > 1024:
+            self.cache.clear()
+        self.cache[offset] = (type, data)
+        return type, data
+
+    def inflate(self, pos, chunk_size=16384):
+        """ Inflate the zlib stream at `pos`. Fed in chunks, the packed stream size is unknown. """
+        inflater, out = zlib.decompressobj(), []
+        while not inflater.eof:
+            chunk = self.pack[pos:pos + chunk_size]
+            if not chunk:
+                raise ValueError(f'truncated pack {self.packfile}')
+            out.append(inflater.decompress(chunk))
+            pos += chunk_size
+        return b''.join(out)
+
+    @staticmethod
+    def apply_delta(source, delta):
+        def varint(pos):
+            value, shift = 0, 0
+            while True:
+                byte = delta[pos]; pos += 1
+                value |= (byte & 0x7f) << shift
+                shift += 7
+                if not byte & 0x80:
+                    return value, pos
+        srcsize, pos = varint(0)
+        dstsize, pos = varint(pos)
+        if srcsize != len(source):
+            raise ValueError('delta source size mismatch')
+        out = bytearray()
+        while pos < len(delta):
+            op = delta[pos]; pos += 1
+            if op & 0x80:   # copy from source
+                offset = size = 0
+                for i in range(4):
+                    if op & (1 << i):
+                        offset |= delta[pos] << (i*8); pos += 1
+                for i in range(3):
+                    if op & (0x10 << i):
+                        size |= delta[pos] << (i*8); pos += 1
+                out += source[offset:offset + (size or 0x10000)]
+            elif op:        # insert
+                out += delta[pos:pos+op]; pos += op
+            else:
+                raise ValueError('invalid delta opcode')
+        if len(out) != dstsize:
+            raise ValueError('delta result size mismatch')
+        return bytes(out)
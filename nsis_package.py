@@ -1,33 +1,80 @@
 from os import listdir, path
 import os
+import sys
 import re
+import json
+import hashlib
+import io
 import zipfile
 import shutil
 import stat
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack
+from threading import Lock
 from subprocess import Popen
 from nsis_version import *
+import nsis_trace
+from nsis_trace import run_traced
 
-def run(args):
+def run(args, env=None):
     """ Execute subprocess and raise exit code exceptions. """
     print(f">> {args}")
-    exitcode = Popen(args).wait()
+    exitcode = run_traced(args, env=env)
     if exitcode != 0:
         raise OSError(exitcode, f"subprocess exit code {exitcode}")
 
 
-def merge_nsis_distros(distro_x86_dir, distro_amd64_dir, windows_x86_dir=None, windows_amd64_dir=None):
+def clone_file(srcfile, dstfile, mode='reflink'):
+    """
+    Clone a file. Returns the method actually used (`hardlink`, `reflink` or `copy`).
+    - reflink:  copy-on-write clone (btrfs, xfs, ...). Falls back to `copy` if the filesystem doesn't support it
+    - hardlink: share the same inode. The build must not modify files in place (i.e. `resource.rc` version rewrite!)
+    - copy:     byte copy
+    """
+    if mode == 'hardlink':
+        try:
+            os.link(srcfile, dstfile)
+            return 'hardlink'
+        except OSError:
+            pass
+    if mode == 'reflink' and sys.platform.startswith('linux'):
+        import fcntl
+        FICLONE = 0x40049409
+        try:
+            with open(srcfile, 'rb') as fsrc, open(dstfile, 'wb') as fdst:
+                fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+            shutil.copystat(srcfile, dstfile)
+            return 'reflink'
+        except OSError:
+            pass
+    shutil.copy2(srcfile, dstfile)
+    return 'copy'
+
+def file_digest(filepath):
+    """ sha256 of a file. """
+    import hashlib
+    with open(filepath, 'rb') as fin:
+        return hashlib.file_digest(fin, 'sha256').hexdigest() if hasattr(hashlib, 'file_digest') else hashlib.sha256(fin.read()).hexdigest()
+
+def merge_nsis_distros(distro_x86_dir, distro_amd64_dir, windows_x86_dir=None, windows_amd64_dir=None, mode='hardlink', dry_run=False, jobs=None):
     """
     Share files (stubs, plugins, etc.) between x86 and amd64 NSIS distribution directories.
+    Missing files are linked instead of copied (see `clone_file`). Files present on both sides are compared by content:
+    identical copies are replaced with links, different ones are reported as conflicts and left alone.
 
     Arguments:
     - distro_x86_dir:     main x86 distribution directory, usually `.instdist-x86`
     - distro_amd64_dir:   main amd64 distribution directory, usually `.instdist-amd64`
     - windows_x86_dir:    Windows distribution directory, usually `.instdist-windows-x86`
     - windows_amd64_dir:  Windows distribution directory, usually `.instdist-windows-amd64`
-    """
+    - mode:               `hardlink`, `reflink` or `copy`
+    - dry_run:            print the merge plan without touching any file
+    - jobs:               number of hashing threads
 
-    # copy files
-    for srcdir, srcre, dstdir in [
+    Returns:
+      Dictionary `{"link": [(src, dst)], "relink": [(src, dst)], "same": [(src, dst)], "conflict": [(src, dst)], "bytes_saved": int}`
+    """
+    rules = [
         # copy Bin\makensisw.exe to root
         [path.join(distro_x86_dir,    'Bin'), r'makensisw\.exe', distro_x86_dir],
         [path.join(distro_amd64_dir,  'Bin'), r'makensisw\.exe', distro_amd64_dir],
@@ -50,17 +97,169 @@ def merge_nsis_distros(distro_x86_dir, distro_amd64_dir, windows_x86_dir=None, w
         # merge x86 and amd64 Bin\RegTool-*.bin
         [path.join(distro_x86_dir,    'Bin'), r'RegTool-x86\.bin',        path.join(distro_amd64_dir, 'Bin')],
         [path.join(distro_amd64_dir,  'Bin'), r'RegTool-amd64\.bin',      path.join(distro_x86_dir,   'Bin')],
-        ]:
+        ]
+
+    # plan. the first rule providing a file wins
+    pairs, planned = [], set()
+    for srcdir, srcre, dstdir in rules:
         if srcdir is None or srcre is None or dstdir is None:
             continue
-        for file in listdir(srcdir):
+        for file in sorted(listdir(srcdir)):
             srcfile = path.join(srcdir, file)
             dstfile = path.join(dstdir, file)
-            if re.match(srcre, file) is not None and path.isfile(srcfile):
-                if not path.exists(dstfile):
-                    os.makedirs(dstdir, exist_ok=True)
-                    print(f"copy2( {srcfile} --> {dstfile} )")
-                    shutil.copy2(srcfile, dstfile)
+            if re.match(srcre, file) is not None and path.isfile(srcfile) and dstfile not in planned:
+                planned.add(dstfile)
+                pairs.append((srcfile, dstfile))
+
+    # compare existing files by content, hashing in parallel (hashlib releases the GIL)
+    existing = [(src, dst) for src, dst in pairs if path.exists(dst)]
+    tohash = {f for src, dst in existing if path.getsize(src) == path.getsize(dst) and not path.samefile(src, dst) for f in (src, dst)}
+    with ThreadPoolExecutor(max_workers=jobs or min(32, (os.cpu_count() or 1) + 4)) as pool:
+        digests = dict(zip(tohash, pool.map(file_digest, tohash)))
+
+    plan = {'link': [], 'relink': [], 'same': [], 'conflict': []}
+    for src, dst in pairs:
+        if not path.exists(dst):
+            plan['link'].append((src, dst))
+        elif path.samefile(src, dst):
+            plan['same'].append((src, dst))
+        elif src in digests and digests[src] == digests[dst]:
+            plan['relink' if mode != 'copy' else 'same'].append((src, dst))
+        else:
+            plan['conflict'].append((src, dst))
+
+    bytes_saved = 0
+    for action in ['relink', 'link', 'conflict']:      # relink first, so new links share the final inodes
+        for src, dst in plan[action]:
+            print(f"{action}( {src} --> {dst} ){' [dry run]' if dry_run else ''}")
+            if action == 'conflict':
+                continue
+            if dry_run:
+                method = mode   # estimate
+            elif action == 'link':
+                os.makedirs(path.dirname(dst), exist_ok=True)
+                method = clone_file(src, dst, mode)
+            else:
+                # link next to the destination, then replace it atomically
+                tmpfile = f'{dst}.{os.getpid()}.tmp'
+                method = clone_file(src, tmpfile, mode)
+                os.replace(tmpfile, dst)
+            if method != 'copy':
+                bytes_saved += path.getsize(src)
+
+    print(f"-- merge: {len(plan['link'])} linked, {len(plan['relink'])} deduplicated, {len(plan['same'])} identical, "
+          f"{len(plan['conflict'])} conflicts, {bytes_saved} bytes saved ({mode}{', dry run' if dry_run else ''})")
+    return dict(plan, bytes_saved=bytes_saved)
+
+
+class PackageManifest:
+    """
+    Digests of the packaging inputs and outputs (artifacts, merged files, installers), persisted between runs.
+    Lets `build_nsis_package` and `build_nsis_installers` skip the stages whose inputs didn't change.
+    A manifest without file lives in memory only.
+    """
+    def __init__(self, file=None):
+        self.file = path.abspath(file) if file else None
+        self.data = {}
+        if self.file and path.exists(self.file):
+            try:
+                with open(self.file) as fin:
+                    self.data = json.load(fin)
+            except ValueError:
+                pass    # rebuild everything
+
+    @staticmethod
+    def key(filepath):
+        return path.normcase(path.abspath(filepath))
+
+    def get(self, section, key, default=None):
+        return self.data.get(section, {}).get(key, default)
+
+    def set(self, section, key, value):
+        self.data.setdefault(section, {})[key] = value
+
+    def save(self):
+        if self.file:
+            tmpfile = f'{self.file}.{os.getpid()}.tmp'
+            with open(tmpfile, 'w') as fout:
+                json.dump(self.data, fout, indent=2)
+            os.replace(tmpfile, self.file)
+
+
+def tree_digest(dir, exclude_re=None):
+    """ Digest of a directory tree (relative paths, sizes and modification times). """
+    hash = hashlib.sha256()
+    for root, dirs, files in os.walk(dir):
+        dirs.sort()
+        for file in sorted(files):
+            relpath = path.relpath(path.join(root, file), dir).replace(os.sep, '/')
+            if exclude_re is not None and re.match(exclude_re, relpath):
+                continue
+            st = os.stat(path.join(root, file))
+            hash.update(f'{relpath}\0{st.st_size}\0{st.st_mtime_ns}\n'.encode())
+    return hash.hexdigest()
+
+
+def artifacts_digest(artifacts_dir, names):
+    """ Content digest of the artifacts (directories or .zip files) that make up one distro. """
+    hash = hashlib.sha256()
+    for name in names:
+        if path.isdir(srcdir := path.join(artifacts_dir, name)):
+            files = [path.join(srcdir, file) for file in sorted(listdir(srcdir)) if re.match(r'^nsis-.+\.zip$', file)]
+        else:
+            files = [srcdir + '.zip']
+        for file in files:
+            hash.update(f'{path.relpath(file, artifacts_dir)}\0{file_digest(file)}\n'.encode())
+    return hash.hexdigest()
+
+
+def extract_stripped(zip, dstdir):
+    """ Extract `zip` into `dstdir`, stripping the root directory of every member. Returns the number of extracted files. """
+    count = 0
+    for info in zip.infolist():
+        parts = info.filename.replace('\\', '/').rstrip('/').split('/')[1:]    # strip the root directory
+        if not parts:
+            continue
+        if any(part in ['', '.', '..'] or ':' in part for part in parts):
+            raise ValueError(f'unsafe zip member "{info.filename}"')
+        dstfile = path.join(dstdir, *parts)
+        if info.is_dir():
+            os.makedirs(dstfile, exist_ok=True)
+            continue
+        os.makedirs(path.dirname(dstfile), exist_ok=True)
+        with zip.open(info) as fin, open(dstfile, 'wb') as fout:
+            shutil.copyfileobj(fin, fout, 1024*1024)
+        if os.name == 'posix' and (mode := (info.external_attr >> 16) & 0o777):
+            os.chmod(dstfile, mode)
+        count += 1
+    return count
+
+
+def extract_artifacts(artifacts_dir, names, dstdir):
+    """
+    Extract the inner `nsis-*.zip` of artifacts `names` to `dstdir`, without intermediate files.
+    An artifact is either a directory or a `.zip` file (in which case the inner zip is read from the outer one).
+    """
+    for name in names:
+        with nsis_trace.span(f'extract {name}', 'step'), ExitStack() as stack:
+            inner = []
+            if path.isdir(srcdir := path.join(artifacts_dir, name)):
+                for file in sorted(listdir(srcdir)):
+                    if re.match(r'^nsis-.+\.zip$', file) is not None:
+                        inner.append((path.join(srcdir, file), stack.enter_context(zipfile.ZipFile(path.join(srcdir, file)))))
+            else:
+                outer = stack.enter_context(zipfile.ZipFile(srcdir + '.zip'))
+                for info in outer.infolist():
+                    if re.match(r'^nsis-.+\.zip$', path.basename(info.filename)) is not None:
+                        # a stored member is seekable in place, a compressed one is inflated to memory once
+                        fileobj = outer.open(info) if info.compress_type == zipfile.ZIP_STORED else io.BytesIO(outer.read(info))
+                        inner.append((f'{srcdir}.zip/{info.filename}', stack.enter_context(zipfile.ZipFile(fileobj))))
+            for srcname, zip in inner:
+                if path.exists(dstdir):
+                    shutil.rmtree(dstdir)
+                print(f"extract( {srcname} --> {dstdir} )")
+                count = extract_stripped(zip, dstdir)
+                print(f"-- {count} files extracted to {dstdir}")
 
 
 def build_nsis_package(
@@ -72,78 +271,110 @@ def build_nsis_package(
         distro_x86_re=r'^.+-ubuntu-[\w\.]+-x86-gcc$',
         distro_amd64_re=r'^.+-ubuntu-[\w\.]+-amd64-gcc$',
         windows_x86_re=r'^.+-windows-[\w\.]+-x86-gcc$',
-        windows_amd64_re=r'^.+-windows-[\w\.]+-amd64-gcc$'
+        windows_amd64_re=r'^.+-windows-[\w\.]+-amd64-gcc$',
+        merge_mode='hardlink',
+        merge_dry_run=False,
+        manifest=None
         ):
-    """ Build x86 and amd64 NSIS distribution packages from `GitHub Actions` artifacts. """
+    """
+    Build x86 and amd64 NSIS distribution packages from `GitHub Actions` artifacts.
+    With a `PackageManifest`, distros whose artifacts didn't change are not extracted again, and only the files merged
+    from re-extracted distros are merged again.
+    """
     artifacts_dir = path.abspath(artifacts_dir)
+    manifest = manifest or PackageManifest()
     # print(f"-- artifacts_dir = {artifacts_dir}")
 
-    # unzip all files in `artifacts`
-    # this step does nothing when running in GitHub workflow, since artifacts are already unzipped
-    for file in listdir(artifacts_dir):
-        zippath = path.join(artifacts_dir, file)
-        if re.match(r'^.*-gcc.zip$', zippath) and path.isfile(zippath):
-            unzipdir = path.join(artifacts_dir, path.splitext(zippath)[0])
-            if not path.exists(unzipdir):
-                print(f"extract( {zippath} --> {unzipdir} )")
-                with zipfile.ZipFile(zippath) as zip:
-                    zip.extractall(unzipdir)
-
-    # extract inner .zip files
-    # (e.g. artifacts-ubuntu-latest-x86-gcc.zip => artifacts-ubuntu-latest-x86-gcc/nsis-1.2.3.4-branch-mingw-gcc-x86.zip)
-    for dir in listdir(artifacts_dir):
-        if path.isdir(path.join(artifacts_dir, dir)):
-
-            for srcre, dstdir in [
-                [distro_x86_re,    distro_x86_dir],
-                [distro_amd64_re,  distro_amd64_dir],
-                [windows_x86_re,   windows_x86_dir],
-                [windows_amd64_re, windows_amd64_dir]
-                ]:
-                if re.match(srcre, dir):
-                    # extract .zip content => dstdir
-                    # (e.g. nsis-1.2.3.4-branch-mingw-gcc-x86.zip => ../.instdist-x86)
-                    for file in listdir(path.join(artifacts_dir, dir)):
-                        if re.match(r'^nsis-.+\.zip$', file) != None:
-                            with zipfile.ZipFile(path.join(artifacts_dir, dir, file)) as zip:
-                                print(f"extract( {path.join(artifacts_dir, dir, file)} --> {artifacts_dir} )")
-                                with zipfile.ZipFile(path.join(artifacts_dir, dir, file)) as zip:
-                                    rootdir = zip.filelist[0].filename.split("/")[0]
-                                    zip.extractall(artifacts_dir)
-                                    if path.exists(dstdir):
-                                        shutil.rmtree(dstdir)
-                                    print(f"rename( {path.join(artifacts_dir, rootdir)} --> {dstdir} )")
-                                    os.rename(path.join(artifacts_dir, rootdir), dstdir)
+    # match artifacts (directories, or .zip files when running locally) to distro directories
+    # (e.g. artifacts-ubuntu-latest-x86-gcc.zip => .instdist-x86)
+    names = [file for file in listdir(artifacts_dir) if path.isdir(path.join(artifacts_dir, file))]
+    names += [name for file in listdir(artifacts_dir)
+              if re.match(r'^.*-gcc.zip$', file) and (name := path.splitext(file)[0]) not in names]
+    jobs = {}
+    for name in sorted(names):
+        for srcre, dstdir in [
+            [distro_x86_re,    distro_x86_dir],
+            [distro_amd64_re,  distro_amd64_dir],
+            [windows_x86_re,   windows_x86_dir],
+            [windows_amd64_re, windows_amd64_dir]
+            ]:
+            if re.match(srcre, name):
+                jobs.setdefault(dstdir, []).append(name)
+
+    def extract(dstdir, artifacts):
+        digest = artifacts_digest(artifacts_dir, artifacts)
+        if path.isdir(dstdir) and manifest.get('artifacts', manifest.key(dstdir)) == digest:
+            return None
+        extract_artifacts(artifacts_dir, artifacts, dstdir)
+        return digest
+
+    # extract the four flavours concurrently (zlib releases the GIL)
+    with ThreadPoolExecutor(max_workers=max(1, len(jobs))) as pool:
+        futures = {dstdir: pool.submit(extract, dstdir, artifacts) for dstdir, artifacts in jobs.items()}
+        digests = {dstdir: future.result() for dstdir, future in futures.items()}
+    extracted = [manifest.key(dstdir) for dstdir, digest in digests.items() if digest is not None]
+    for dstdir, digest in digests.items():
+        if digest is not None:
+            manifest.set('artifacts', manifest.key(dstdir), digest)
+        else:
+            print(f"-- {dstdir} is up to date")
+    manifest.save()
+
+    # files merged from a re-extracted distro into an untouched one are stale
+    inside = lambda file, dirs: any(file.startswith(dir + os.sep) for dir in dirs)
+    for dst, src in manifest.data.get('merged', {}).items():
+        if inside(src, extracted) and not inside(dst, extracted) and path.exists(dst):
+            print(f"remove( {dst} ) [stale]")
+            os.remove(dst)
 
     # share files between distros
-    merge_nsis_distros(distro_x86_dir, distro_amd64_dir, windows_x86_dir, windows_amd64_dir)
+    result = merge_nsis_distros(distro_x86_dir, distro_amd64_dir, windows_x86_dir, windows_amd64_dir, merge_mode, merge_dry_run)
+    if not merge_dry_run:
+        manifest.data['merged'] = {manifest.key(dst): manifest.key(src) for action in ['link', 'relink', 'same'] for src, dst in result[action]}
+        manifest.save()
+    return result
 
 
-def build_nsis_installer(
+def installer_command(
         distro_dir,
         arch,
-        major_version=nsis_major_version(),
-        minor_version=nsis_minor_version(),
-        revision_number=nsis_revision_number(),
+        major_version=None,
+        minor_version=None,
+        revision_number=None,
         build_number=0,
         outfile=None,
-        verbose_level=4
+        verbose_level=4,
+        defines=None
         ):
-    """ Build NSIS installer from an existing distribution package. """
+    """
+    makensis command line that builds the NSIS installer from an existing distribution package.
+    Missing version numbers are read from the source tree. `defines` are extra `-D` symbols (`{name: value}`, or `{name: None}`).
+    The process environment is left untouched, the command gets its own.
+
+    Returns:
+      Tuple `(args, env, outfile)`
+    """
+    major_version = nsis_major_version() if major_version is None else major_version
+    minor_version = nsis_minor_version() if minor_version is None else minor_version
+    revision_number = nsis_revision_number() if revision_number is None else revision_number
+
     # hack: set NSISDIR and NSISCONFDIR variables to help makensis find its stuff (headers, stubs) on posix
     distro_dir = path.abspath(distro_dir)
-
-    os.environ['NSISDIR'] = distro_dir
-    os.environ['NSISCONFDIR'] = distro_dir
+    env = dict(os.environ, NSISDIR=distro_dir, NSISCONFDIR=distro_dir)
 
     makensis = path.join(distro_dir, 'makensis.exe' if os.name == 'nt' else 'makensis')      # 'makensis' on posix, 'makensis.exe' on windows
     if os.name == 'posix':
         mode = stat.S_IMODE(os.lstat(makensis).st_mode)
         os.chmod(makensis, mode | stat.S_IXUSR)     # `chmod u+x makensis`
 
+    defines = dict(defines or {})
+    outfile = defines.pop('OUTFILE', None) or outfile
+    if outfile is None:
+        outfile = path.join(distro_dir, f"nsis-{nsis_version(major_version, minor_version, revision_number, build_number)}-{nsis_distro_name()}-{arch}.exe")
+
     args = [
         makensis,
-        f'-DOUTFILE={outfile if outfile is not None else path.join(distro_dir, f"nsis-{nsis_version(major_version, minor_version, revision_number, build_number)}-{nsis_distro_name()}-{arch}.exe")}',
+        f'-DOUTFILE={outfile}',
         f'-DVERSION={nsis_version(major_version, minor_version, revision_number, build_number)}',
         f'-DVER_MAJOR={major_version}',
         f'-DVER_MINOR={minor_version}',
@@ -153,10 +384,88 @@ def build_nsis_installer(
         r'-DVER_PRODUCTNAME=Unofficial NSIS fork by Marius Negrutiu',
         r'-DVER_LEGALTRADEMARKS=https://github.com/negrutiu/nsis',
         r'-DEXTRA_WELCOME_TEXT=$\r$\n$\r$\n$\r$\n(*) This is an unofficial fork from https://github.com/negrutiu/nsis$\r$\n',
+        ] + [f'-D{name}' if value is None else f'-D{name}={value}' for name, value in defines.items()] + [
         f'-V{verbose_level}',
         path.join(distro_dir, 'Examples', 'makensis-fork.nsi')
     ]
-    run(args)
+    return args, env, outfile
+
+
+def build_nsis_installer(
+        distro_dir,
+        arch,
+        major_version=None,
+        minor_version=None,
+        revision_number=None,
+        build_number=0,
+        outfile=None,
+        verbose_level=4,
+        defines=None
+        ):
+    """ Build NSIS installer from an existing distribution package. Missing version numbers are read from the source tree. Returns the installer path. """
+    args, env, outfile = installer_command(distro_dir, arch, major_version, minor_version, revision_number, build_number, outfile, verbose_level, defines)
+    run(args, env=env)
+    return outfile
+
+
+def build_nsis_installers(
+        jobs,
+        major_version=None,
+        minor_version=None,
+        revision_number=None,
+        build_number=0,
+        verbose_level=4,
+        parallel=True,
+        manifest=None
+        ):
+    """
+    Build several NSIS installers concurrently, each makensis with its own environment.
+    `jobs` is a list of `(distro_dir, arch, defines)` (i.e. x86, amd64, and extra variants such as strlen_8192 distros).
+    The output of every job is printed as one block, when the job ends.
+    With a `PackageManifest`, an installer is rebuilt only if its distro tree or its command line (defines, version) changed.
+
+    Returns:
+      List of dictionaries `{"distro_dir": str, "arch": str, "defines": dict, "outfile": str, "exitcode": int, "output": str}`.
+      Raises `OSError` if any installer failed, after all of them finished.
+    """
+    # resolve everything (versions, output files) before starting the threads
+    commands = [installer_command(distro_dir, arch, major_version, minor_version, revision_number, build_number, None, verbose_level, defines)
+                for distro_dir, arch, defines in jobs]
+    outfiles = [path.normcase(path.abspath(outfile)) for args, env, outfile in commands]
+    if len(set(outfiles)) != len(outfiles):
+        raise ValueError('installer jobs must have distinct output files (use distinct distro directories or an OUTFILE define)')
+
+    # skip the installers whose distro tree and command line didn't change
+    manifest = manifest or PackageManifest()
+    keys = [hashlib.sha256(json.dumps([args, tree_digest(distro_dir, r'^nsis-.*\.exe$')]).encode()).hexdigest()
+            for (distro_dir, arch, defines), (args, env, outfile) in zip(jobs, commands)]
+    uptodate = [path.exists(outfile) and manifest.get('installers', manifest.key(outfile)) == key for (args, env, outfile), key in zip(commands, keys)]
+
+    lock = Lock()
+    def build(job, command, uptodate):
+        if uptodate:
+            print(f"-- {path.basename(command[2])} is up to date")
+            return {'distro_dir': job[0], 'arch': job[1], 'defines': job[2], 'outfile': command[2], 'exitcode': 0, 'output': ''}
+        args, env, outfile = command
+        exitcode, output = nsis_trace.run_captured(args, env=env)
+        with lock:
+            print(f">> {args}")
+            print(output, end='' if output.endswith('\n') else '\n')
+            print(f"-- {path.basename(outfile)}: exit code {exitcode}")
+        return {'distro_dir': job[0], 'arch': job[1], 'defines': job[2], 'outfile': outfile, 'exitcode': exitcode, 'output': output}
+
+    with ThreadPoolExecutor(max_workers=max(1, len(jobs)) if parallel else 1) as pool:
+        results = list(pool.map(build, jobs, commands, uptodate))
+
+    for result, key in zip(results, keys):
+        if result['exitcode'] == 0:
+            manifest.set('installers', manifest.key(result['outfile']), key)
+    manifest.save()
+
+    failed = [result for result in results if result['exitcode'] != 0]
+    if failed:
+        raise OSError(failed[0]['exitcode'], f"{len(failed)}/{len(results)} installers failed: {', '.join(path.basename(r['outfile']) for r in failed)}")
+    return results
 
 
 if __name__ == '__main__':
@@ -164,10 +473,20 @@ if __name__ == '__main__':
     parser = ArgumentParser()
     parser.add_argument("-a", "--artifacts-dir", type=str, default='artifacts')
     parser.add_argument("-b", "--build-number", type=int, default=0)
+    parser.add_argument("--merge-mode", type=str, default='hardlink', choices=['hardlink', 'reflink', 'copy'], help='How files are shared between the x86 and amd64 distros')
+    parser.add_argument("--merge-dry-run", action='store_true', help='Print the merge plan and stop before building the installers')
+    parser.add_argument("--manifest", type=str, default='.nsis-package.json', help='Packaging manifest. Unchanged artifacts and installers are skipped. Empty string repackages everything')
+    parser.add_argument("--trace", type=str, default='.trace-package.json', help='Packaging trace file (Chrome trace format). Empty string disables tracing. Ignored if NSIS_TRACE_FILE is already set')
     args = parser.parse_args()
 
-    build_nsis_package(args.artifacts_dir)
+    if args.trace and nsis_trace.start_trace(args.trace):
+        import atexit
+        atexit.register(nsis_trace.finish_trace)
+
+    manifest = PackageManifest(args.manifest or None)
+    build_nsis_package(args.artifacts_dir, merge_mode=args.merge_mode, merge_dry_run=args.merge_dry_run, manifest=manifest)
+    if args.merge_dry_run:
+        sys.exit(0)
 
-    for arch in ['x86', 'amd64']:
-        print("\n--------------------------------------------------------------------------------\n")
-        build_nsis_installer(f'.instdist-{arch}', arch, build_number=args.build_number, verbose_level=3)
+    print("\n--------------------------------------------------------------------------------\n")
+    build_nsis_installers([(f'.instdist-{arch}', arch, None) for arch in ['x86', 'amd64']], build_number=args.build_number, verbose_level=3, manifest=manifest)
@@ -0,0 +1,398 @@
+import hashlib
+import json
+import os
+import re
+import shutil
+import time
+from glob import glob, has_magic
+from os import path
+from concurrent.futures import ThreadPoolExecutor
+from xml.etree import ElementTree
+import nsis_trace
+
+# Test scripts runner for the `test-scripts` target.
+# Every .nsi of the test distribution is compiled by makensis, in a bounded pool of processes.
+# Results (status, duration, peak memory, installer size) are written as JUnit XML and as a JSON summary.
+# `--shard i/n` runs a deterministic subset of the suite, so CI can split it across jobs.
+# `--cache FILE` skips the scripts whose inputs (see `DependencyScanner`) already passed.
+
+NEVER_TESTED = ['Examples' + os.sep + 'AppGen.nsi']    # not a real installer
+
+
+def parse_list(value):
+    """ Comma-separated list of the `SKIPTESTS`/`IGNORETESTS` options. `none` and empty strings are empty lists. """
+    return [item.replace('/', os.sep) for item in str(value or '').split(',') if item and item != 'none']
+
+
+def parse_shard(value):
+    """ Parse `i/n` (1 <= i <= n). Returns `(index, count)`, `None` if `value` is empty. """
+    if not value:
+        return None
+    match = re.match(r'^\s*(\d+)\s*/\s*(\d+)\s*$', str(value))
+    if not match or not 1 <= int(match[1]) <= int(match[2]):
+        raise ValueError(f'invalid shard "{value}", expected i/n with 1 <= i <= n')
+    return int(match[1]), int(match[2])
+
+
+def find_scripts(testdir, skipped=[], ignored=[], shard=None):
+    """
+    The .nsi files of `testdir`, sorted by name (relative to `testdir`).
+    Returns list of `(name, filepath, mode)`, mode is `run`, `ignore` (run, failure ignored) or `skip`.
+    """
+    scripts = []
+    for root, dirs, files in os.walk(testdir):
+        for file in files:
+            if file[-4:] == '.nsi':
+                filepath = path.join(root, file)
+                name = path.relpath(filepath, testdir)
+                if name in skipped or name in NEVER_TESTED:
+                    mode = 'skip'
+                elif name in ignored:
+                    mode = 'ignore'
+                else:
+                    mode = 'run'
+                scripts.append((name, filepath, mode))
+    scripts.sort()
+    if shard:
+        index, count = shard
+        scripts = scripts[index - 1::count]
+    return scripts
+
+
+def compile_script(makensis, filepath, env=None):
+    """ Compile one script. Returns `(exitcode, duration, peak_rss, outfile_size, output)`. """
+    from subprocess import Popen, PIPE, STDOUT
+    start = time.time()
+    process = Popen([makensis, filepath], stdout=PIPE, stderr=STDOUT, env=env)
+    with process.stdout:
+        output = process.stdout.read().decode('utf-8', errors='replace')
+    exitcode, peak_rss = nsis_trace.wait_peak_rss(process)
+    duration = time.time() - start
+    nsis_trace.record(path.basename(filepath), 'test', start, duration, exitcode=exitcode, peak_rss=peak_rss)
+    size = None
+    # makensis prints `Output: "<installer>"` on success
+    if exitcode == 0 and (match := re.search(r'^Output:\s*"(.+)"\s*$', output, re.MULTILINE)):
+        try:
+            size = path.getsize(path.join(path.dirname(filepath), match[1]))
+        except OSError:
+            pass
+    return exitcode, duration, peak_rss, size, output
+
+
+class DependencyScanner:
+    """
+    Resolves the inputs of a script: the script, its headers (`!include`, `!addincludedir`, `!makensis`),
+    plug-ins (`Name::Function`, `!addplugindir`) and files (`File`, `Icon`, `${NSISDIR}\\...`, ...), plus makensis,
+    the stubs and nsisconf.nsh of `nsisdir`.
+    Conditionals (`!if`, `!ifdef`, ...) are not evaluated, every branch counts: the result is a superset.
+    Symbols are expanded with every value `!define`d for them, unknown symbols become wildcards.
+    `!insertmacro` expands the body of the macro with its arguments.
+    The file system is only accessed through `find` and `tree` (the SCons scanner looks up build nodes instead).
+    """
+    UNCACHEABLE = ['!system', '!execute', '!packhdr', '!finalize', '!uninstfinalize']   # results depend on external commands
+    FILE_COMMANDS = ['file', 'reservefile', 'icon', 'uninstallicon', 'licensedata', 'checkbitmap', 'changeui', 'loadlanguagefile',
+                     '!define', '!getdllversion', '!gettlbversion', '!searchparse']
+    COMMANDS = set(UNCACHEABLE + FILE_COMMANDS + ['!include', '!makensis', '!addincludedir', '!addplugindir', '!macro', '!macroend', '!insertmacro'])
+
+    def __init__(self, nsisdir, makensis):
+        self.nsisdir = path.abspath(nsisdir)
+        self.digests = {}
+        self.parsed = {}
+        self.matches = {}
+        self.base = [path.abspath(shutil.which(makensis) or makensis)] + sorted(self.match(['nsisconf.nsh', 'Stubs'], [self.nsisdir], True))
+
+    def find(self, pattern):
+        """ Existing files and directories matching `pattern`. Returns list of `(path, isdir)`. """
+        return [(found, path.isdir(found)) for found in (glob(pattern) if has_magic(pattern) else [pattern]) if path.exists(found)]
+
+    def tree(self, dir):
+        """ Files of `dir` and its subdirectories. """
+        return sorted(path.join(root, file) for root, dirs, files in os.walk(dir) for file in files)
+
+    def digest(self, file):
+        if file not in self.digests:
+            try:
+                with open(file, 'rb') as fin:
+                    self.digests[file] = hashlib.sha256(fin.read()).hexdigest()
+            except OSError:
+                self.digests[file] = None
+        return self.digests[file]
+
+    def read(self, file):
+        """ Content of a script or header, empty if it can't be read. """
+        try:
+            with open(file, 'rb') as fin:
+                return fin.read()
+        except OSError:
+            return b''
+
+    def parse(self, file):
+        """ Tokenized lines of a script or header. Returns list of token lists. """
+        if file not in self.parsed:
+            data = self.read(file)
+            text = data.decode('utf-16') if data[:2] in [b'\xff\xfe', b'\xfe\xff'] else data.decode('utf-8', errors='replace')
+            text = re.sub(r'/\*.*?\*/', ' ', text, flags=re.DOTALL).replace('\\\r\n', ' ').replace('\\\n', ' ')
+            lines = []
+            for line in text.splitlines():
+                tokens = []
+                for match in re.finditer(r'"((?:\$\\.|[^"])*)"|\'([^\']*)\'|`([^`]*)`|([^\s"\'`]+)', line):
+                    token = next(group for group in match.groups() if group is not None)
+                    if match[4] is not None and token[0] in ';#':
+                        break   # comment
+                    tokens.append(token)
+                # keep the lines that may reference other files only
+                if tokens and (tokens[0].lower() in self.COMMANDS or any('::' in token or '${NSIS' in token for token in tokens)):
+                    lines.append(tokens)
+            self.parsed[file] = lines
+        return self.parsed[file]
+
+    def expand(self, text, defines, filedir):
+        """ Possible values of `text` after symbol expansion, as glob patterns with `/` separators. """
+        builtins = {'NSISDIR': self.nsisdir, 'NSISCONFDIR': self.nsisdir, '__FILEDIR__': filedir}
+        results = {text}
+        for _ in range(8):
+            expanded = set()
+            for value in results:
+                if match := re.search(r'\$\{([^${}]+)\}', value):
+                    symbol = match[1]
+                    values = [builtins[symbol]] if symbol in builtins else sorted(defines.get(symbol, ['*']))[:8]
+                    expanded.update(value[:match.start()] + v + value[match.end():] for v in values)
+                else:
+                    expanded.add(value)
+            if expanded == results or len(expanded) > 32:
+                break
+            results = expanded
+        patterns = set(re.sub(r'\$\{[^}]*\}|\$\([^)]*\)', '*', value).replace('\\', '/') for value in results)
+        # a file name made of symbols only (i.e. a macro parameter) could be anything, its files are found at the call site
+        return set(pattern for pattern in patterns if not re.fullmatch(r'[*?]*', path.basename(pattern)))
+
+    def match(self, patterns, dirs, trees=False):
+        """ Existing files matching `patterns` (absolute, or relative to any of `dirs`). Directories expand to their files if `trees`. """
+        memo = (tuple(sorted(patterns)), tuple(dirs), trees)
+        if memo in self.matches:
+            return self.matches[memo]
+        files = set()
+        for pattern in patterns:
+            for candidate in ([pattern] if path.isabs(pattern) else [path.join(dir, pattern) for dir in dirs]):
+                for found, isdir in self.find(candidate):
+                    if not isdir:
+                        files.add(path.normpath(found))
+                    elif trees and path.normpath(found) != self.nsisdir:
+                        files.update(self.tree(found))
+        self.matches[memo] = files
+        return files
+
+    def scan(self, script):
+        """ Returns `(inputs, cacheable)`, `inputs` is the sorted list of input files of `script`. """
+        scriptdir = path.dirname(path.abspath(script))
+        state = {'defines': {}, 'macros': {}, 'inserted': set(), 'includedirs': [], 'plugindirs': [], 'files': set(self.base), 'cacheable': True}
+        self.scan_file(path.abspath(script), scriptdir, state, set())
+        return sorted(state['files']), state['cacheable']
+
+    def scan_file(self, file, scriptdir, state, visited):
+        if file in visited:
+            return
+        visited.add(file)
+        state['files'].add(file)
+        self.scan_lines(self.parse(file), path.dirname(file), scriptdir, state, visited)
+
+    def scan_lines(self, lines, filedir, scriptdir, state, visited, depth=0):
+        defines = state['defines']
+        body = None
+        for tokens in lines:
+            command = tokens[0].lower()
+            args = [token for token in tokens[1:] if not re.match(r'^/[\w-]+(=.*)?$', token)]   # drop /FLAGS
+            if command == '!macro' and len(tokens) > 1:
+                body = []
+                state['macros'][tokens[1]] = (tokens[2:], body, filedir)
+                continue
+            elif command == '!macroend':
+                body = None
+                continue
+            elif body is not None:
+                body.append(tokens)     # and scanned as is, in case the macro is never inserted
+            if command in self.UNCACHEABLE:
+                state['cacheable'] = False
+            elif command == '!define' and args:
+                defines.setdefault(args[0], set()).add(args[1] if len(args) > 1 else '')
+            elif command == '!include' and args:
+                dirs = [filedir, scriptdir] + state['includedirs'] + [path.join(self.nsisdir, 'Include')]
+                for header in sorted(self.match(self.expand(args[0], defines, filedir), dirs)):
+                    self.scan_file(header, scriptdir, state, visited)
+            elif command == '!makensis' and args:
+                for arg in re.findall(r'"([^"]+\.nsi)"|(\S+\.nsi)\b', args[0], re.IGNORECASE):
+                    for nested in sorted(self.match(self.expand(arg[0] or arg[1], defines, filedir), [scriptdir, filedir])):
+                        self.scan_file(nested, path.dirname(nested), state, visited)
+            elif command in ['!addincludedir', '!addplugindir'] and args:
+                for pattern in self.expand(args[0], defines, filedir):
+                    for dir, isdir in self.find(pattern if path.isabs(pattern) else path.join(scriptdir, pattern)):
+                        state['includedirs' if command == '!addincludedir' else 'plugindirs'].append(dir)
+            elif command == '!insertmacro' and len(tokens) > 1:
+                params, lines, macrodir = state['macros'].get(tokens[1], ([], [], filedir))
+                values = dict(zip(params, tokens[2:]))
+                # without arguments, the body is the same as scanned with the definition
+                if values and lines and depth < 8 and (tokens[1], tuple(tokens[2:])) not in state['inserted']:
+                    state['inserted'].add((tokens[1], tuple(tokens[2:])))
+                    expanded = [[re.sub(r'\$\{([^${}]+)\}', lambda m: values.get(m[1], m[0]), token) for token in line] for line in lines]
+                    self.scan_lines(expanded, macrodir, scriptdir, state, visited, depth + 1)
+                # arguments may be files too (i.e. MUI_PAGE_LICENSE)
+                for arg in tokens[2:]:
+                    if re.search(r'[./\\]', arg) and '$' not in arg:
+                        state['files'].update(self.match(self.expand(arg, defines, filedir), [scriptdir, filedir]))
+            if command in self.FILE_COMMANDS:
+                for arg in args[1:] if command == '!define' else args:
+                    if command not in ['file', 'reservefile'] and not re.search(r'[./\\*$]', arg):
+                        continue    # not a path (files and directories may be bare names, i.e. `File /r data`)
+                    state['files'].update(self.match(self.expand(arg, defines, filedir), [scriptdir, filedir], command in ['file', 'reservefile']))
+            for token in tokens:
+                if '${NSISDIR}' in token or '${NSISCONFDIR}' in token:
+                    state['files'].update(self.match(self.expand(token, defines, filedir), []))
+                for plugin in [] if '::' not in token else re.findall(r'(?<![\w$])([A-Za-z_]\w*)::[A-Za-z_]\w*', token):
+                    dirs = [path.join(self.nsisdir, 'Plugins', '*')] + state['plugindirs']
+                    state['files'].update(self.match([plugin + '.dll'], dirs))
+
+    def key(self, name, script):
+        """ Content key of a script, `None` if its result can't be cached. """
+        inputs, cacheable = self.scan(script)
+        if not cacheable:
+            return None
+        files = [(path.relpath(file, self.nsisdir) if file.startswith(self.nsisdir) else file).replace(os.sep, '/') for file in inputs]
+        return hashlib.sha256(json.dumps([name.replace(os.sep, '/')] + [[file, self.digest(input)] for file, input in zip(files, inputs)]).encode()).hexdigest()
+
+
+class ResultCache:
+    """ Passed scripts by content key, persisted in a JSON file. The most recently used `limit` entries are kept. """
+    def __init__(self, file, limit=4096):
+        self.file, self.limit = file, limit
+        try:
+            with open(file) as fin:
+                self.entries = json.load(fin)
+        except (OSError, ValueError):
+            self.entries = {}
+
+    def get(self, key):
+        if key is None or key not in self.entries:
+            return None
+        self.entries[key] = self.entries.pop(key)  # most recently used last
+        return self.entries[key]
+
+    def set(self, key, result):
+        if key is not None:
+            self.entries.pop(key, None)
+            self.entries[key] = dict((k, result[k]) for k in ['name', 'duration', 'peak_rss', 'size'])
+
+    def save(self):
+        entries = dict(list(self.entries.items())[-self.limit:])
+        os.makedirs(path.dirname(path.abspath(self.file)), exist_ok=True)
+        tmpfile = f'{self.file}.{os.getpid()}.tmp'
+        with open(tmpfile, 'w') as fout:
+            json.dump(entries, fout, indent=1)
+        os.replace(tmpfile, self.file)
+
+
+def run_tests(testdir, makensis, skipped=[], ignored=[], shard=None, jobs=None, env=None, verbose=False, cachefile=None):
+    """
+    Compile the test scripts of `testdir`. Returns the summary dictionary (see `write_json`).
+    A test fails if makensis fails, except for the `ignored` scripts.
+    With a `cachefile`, scripts whose inputs already passed are not compiled again.
+    """
+    start = time.time()
+    scripts = find_scripts(testdir, skipped, ignored, shard)
+    env = dict((str(k), str(v)) for k, v in env.items()) if env is not None else None
+    cache = ResultCache(cachefile) if cachefile else None
+    scanner = DependencyScanner(testdir, makensis) if cache else None
+    keys = dict((name, scanner.key(name, filepath) if scanner else None) for name, filepath, mode in scripts if mode != 'skip')
+    todo = [(name, filepath) for name, filepath, mode in scripts if mode != 'skip' and not (cache and cache.get(keys[name]))]
+    jobs = max(1, min(jobs or os.cpu_count() or 1, len(todo) or 1))
+
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        futures = dict((name, pool.submit(compile_script, makensis, filepath, env)) for name, filepath in todo)
+        results = []
+        for name, filepath, mode in scripts:
+            result = {'name': name.replace(os.sep, '/'), 'status': 'skipped', 'duration': 0, 'peak_rss': None, 'size': None}
+            if name in futures:
+                exitcode, duration, peak_rss, size, output = futures[name].result()
+                if exitcode == 0:
+                    status = 'passed'
+                else:
+                    status = 'ignored' if mode == 'ignore' else 'failed'
+                result.update({'status': status, 'exitcode': exitcode, 'duration': round(duration, 3), 'peak_rss': peak_rss, 'size': size})
+                if status != 'passed':
+                    result['output'] = output
+                elif cache:
+                    cache.set(keys[name], result)
+                print('-- ' + format_result(result))
+                if verbose or status == 'failed':
+                    print(output)
+            elif mode != 'skip':
+                result.update(cache.get(keys[name]), status='passed', exitcode=0, cached=True)
+                print('-- ' + format_result(result))
+            results.append(result)
+    if cache:
+        cache.save()
+
+    counts = dict((status, len([r for r in results if r['status'] == status])) for status in ['passed', 'failed', 'ignored', 'skipped'])
+    return dict(makensis=str(makensis), shard='%d/%d' % shard if shard else None, jobs=jobs, cached=len([r for r in results if r.get('cached')]),
+                duration=round(time.time() - start, 3), total=len(results), **counts, scripts=results)
+
+
+def format_result(result):
+    """ One line report of a script: status, duration, peak memory, installer size, name. """
+    size = result['size'] if result['size'] is not None else '-'
+    status = 'cached' if result.get('cached') else result['status']
+    return f"{status:7} {result['duration']:7.2f}s {(result['peak_rss'] or 0) / 1048576:7.1f} MiB {size:>9}  {result['name']}"
+
+
+def write_json(summary, file):
+    with open(file, 'w') as fout:
+        json.dump(summary, fout, indent=2)
+
+
+def write_junit(summary, file):
+    """ JUnit XML report, one `testcase` per script. """
+    suite = ElementTree.Element('testsuite', name='test-scripts', tests=str(summary['total']), failures=str(summary['failed']),
+                                skipped=str(summary['skipped'] + summary['ignored']), time=str(summary['duration']))
+    for result in summary['scripts']:
+        classname, _, name = result['name'].rpartition('/')
+        case = ElementTree.SubElement(suite, 'testcase', classname=classname.replace('/', '.') or 'test-scripts', name=name, time=str(result['duration']))
+        if result['status'] == 'failed':
+            ElementTree.SubElement(case, 'failure', message=f"makensis exit code {result['exitcode']}").text = result['output']
+        elif result['status'] == 'ignored':
+            ElementTree.SubElement(case, 'skipped', message=f"failure ignored (IGNORETESTS), makensis exit code {result['exitcode']}").text = result['output']
+        elif result['status'] == 'skipped':
+            ElementTree.SubElement(case, 'skipped', message='not tested (SKIPTESTS)')
+        if measured := [key for key in ['peak_rss', 'size', 'cached'] if result.get(key) is not None]:
+            properties = ElementTree.SubElement(case, 'properties')
+            for key in measured:
+                ElementTree.SubElement(properties, 'property', name=key, value=str(result[key]))
+    ElementTree.ElementTree(suite).write(file, encoding='utf-8', xml_declaration=True)
+
+
+if __name__ == '__main__':
+    from argparse import ArgumentParser
+    parser = ArgumentParser(description='Compile the NSIS test scripts')
+    parser.add_argument("testdir", type=str, help='Test distribution directory (NSISDIR of the tested makensis)')
+    parser.add_argument("--makensis", type=str, default=None, help='makensis executable. Default is the one from the test distribution')
+    parser.add_argument("--skip", type=str, default='', help='Comma-separated list of scripts that are not ran (SKIPTESTS)')
+    parser.add_argument("--ignore", type=str, default='', help='Comma-separated list of scripts whose failures are ignored (IGNORETESTS)')
+    parser.add_argument("--shard", type=str, default=None, help='Run only the i-th of n shards (i/n)')
+    parser.add_argument("-j", "--jobs", type=int, default=None, help='Number of concurrent makensis processes. Default is the number of cores')
+    parser.add_argument("--junit", type=str, default=None, help='JUnit XML report file')
+    parser.add_argument("--json", type=str, default=None, help='JSON summary file')
+    parser.add_argument("--cache", type=str, default=None, help='Result cache file. Scripts whose inputs already passed are not compiled again')
+    parser.add_argument("-v", "--verbose", action='store_true', help='Print the output of every script')
+    args = parser.parse_args()
+
+    makensis = args.makensis
+    if makensis is None:
+        exe = 'makensis.exe' if os.name == 'nt' else 'makensis'
+        makensis = next((f for f in [path.join(args.testdir, exe), path.join(args.testdir, 'Bin', exe)] if path.isfile(f)), exe)
+    env = dict(os.environ, NSISDIR=path.abspath(args.testdir), NSISCONFDIR=path.abspath(args.testdir))
+
+    summary = run_tests(args.testdir, makensis, parse_list(args.skip), parse_list(args.ignore), parse_shard(args.shard), args.jobs, env, args.verbose, args.cache)
+    if args.junit:
+        write_junit(summary, args.junit)
+    if args.json:
+        write_json(summary, args.json)
+    print(f"-- {summary['passed']} passed ({summary['cached']} cached), {summary['failed']} failed, {summary['ignored']} ignored, {summary['skipped']} skipped in {summary['duration']:.2f}s")
+    exit(1 if summary['failed'] else 0)
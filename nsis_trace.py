@@ -0,0 +1,191 @@
+import json
+import os
+import sys
+import threading
+import time
+from os import path
+
+# Build telemetry.
+# Every traced step appends a "complete" event to `{NSIS_TRACE_FILE}.events` (one JSON object per line, safe for concurrent processes).
+# The process that owns the trace converts the events into a single Chrome trace file (chrome://tracing, https://ui.perfetto.dev)
+
+def trace_file():
+    """ Trace file of the current build, or `None` if tracing is disabled. """
+    return os.environ.get('NSIS_TRACE_FILE') or None
+
+
+def start_trace(tracefile):
+    """
+    Start tracing the current build into `tracefile`, unless a parent process already did.
+    Child processes inherit the `NSIS_TRACE_FILE` variable and append to the same trace.
+    Returns `True` if the caller owns the trace and must call `finish_trace()`.
+    """
+    if trace_file():
+        return False
+    tracefile = path.abspath(tracefile)
+    os.makedirs(path.dirname(tracefile), exist_ok=True)
+    if path.exists(tracefile + '.events'):
+        os.remove(tracefile + '.events')
+    os.environ['NSIS_TRACE_FILE'] = tracefile
+    return True
+
+
+def record(name, cat, start, duration, **args):
+    """ Append an event to the trace. `start` is a `time.time()` timestamp, `duration` is in seconds. """
+    tracefile = trace_file()
+    if tracefile is None:
+        return
+    event = {'name': name, 'cat': cat, 'ph': 'X', 'ts': int(start * 1000000), 'dur': int(duration * 1000000),
+             'pid': os.getpid(), 'tid': threading.get_ident(), 'args': args}
+    with open(tracefile + '.events', 'a') as fout:
+        fout.write(json.dumps(event, default=str) + '\n')
+
+
+class span:
+    """ Context manager that records the enclosed block as a trace event. """
+    def __init__(self, name, cat='step', **args):
+        self.name, self.cat, self.args = name, cat, args
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if exc_type is not None:
+            self.args['error'] = repr(exc_value)
+        record(self.name, self.cat, self.start, time.time() - self.start, **self.args)
+
+
+def wait_peak_rss(process):
+    """ Wait for a `subprocess.Popen` process to exit. Returns `(exitcode, peak_rss_bytes)`. """
+    if hasattr(os, 'wait4'):
+        pid, status, rusage = os.wait4(process.pid, 0)
+        process.returncode = os.waitstatus_to_exitcode(status)
+        return process.returncode, rusage.ru_maxrss * (1 if sys.platform == 'darwin' else 1024)    # KiB on linux, bytes on macos
+    exitcode = process.wait()
+    peak_rss = None
+    if os.name == 'nt':
+        import ctypes
+        from ctypes import wintypes
+        class PROCESS_MEMORY_COUNTERS(ctypes.Structure):
+            _fields_ = [('cb', wintypes.DWORD), ('PageFaultCount', wintypes.DWORD)] + \
+                       [(name, ctypes.c_size_t) for name in ['PeakWorkingSetSize', 'WorkingSetSize', 'QuotaPeakPagedPoolUsage', 'QuotaPagedPoolUsage',
+                                                             'QuotaPeakNonPagedPoolUsage', 'QuotaNonPagedPoolUsage', 'PagefileUsage', 'PeakPagefileUsage']]
+        counters = PROCESS_MEMORY_COUNTERS()
+        counters.cb = ctypes.sizeof(counters)
+        if ctypes.windll.psapi.GetProcessMemoryInfo(wintypes.HANDLE(int(process._handle)), ctypes.byref(counters), counters.cb):
+            peak_rss = counters.PeakWorkingSetSize
+    return exitcode, peak_rss
+
+
+def run_traced(args, **kwargs):
+    """ Execute a subprocess and record its span (command, cwd, duration, exit code, peak RSS). Returns the exit code. """
+    from subprocess import Popen
+    start = time.time()
+    exitcode, peak_rss = wait_peak_rss(Popen(args, **kwargs))
+    record(path.basename(str(args[0])), 'run', start, time.time() - start,
+           command=[str(a) for a in args], cwd=kwargs.get('cwd') or os.getcwd(), exitcode=exitcode, peak_rss=peak_rss)
+    return exitcode
+
+
+def run_captured(args, **kwargs):
+    """ Like `run_traced`, but captures the subprocess output (stdout and stderr). Returns `(exitcode, output)`. """
+    from subprocess import Popen, PIPE, STDOUT
+    start = time.time()
+    process = Popen(args, stdout=PIPE, stderr=STDOUT, **kwargs)
+    with process.stdout:
+        output = process.stdout.read().decode('utf-8', errors='replace')
+    exitcode, peak_rss = wait_peak_rss(process)
+    record(path.basename(str(args[0])), 'run', start, time.time() - start,
+           command=[str(a) for a in args], cwd=kwargs.get('cwd') or os.getcwd(), exitcode=exitcode, peak_rss=peak_rss)
+    return exitcode, output
+
+
+def finish_trace():
+    """ Convert the recorded events into the Chrome trace file. Returns the trace file path. """
+    tracefile = trace_file()
+    if tracefile is None:
+        return None
+    events = []
+    if path.exists(tracefile + '.events'):
+        with open(tracefile + '.events') as fin:
+            events = [json.loads(line) for line in fin if line.strip()]
+        os.remove(tracefile + '.events')
+    events.sort(key=lambda e: e['ts'])
+    with open(tracefile, 'w') as fout:
+        json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, fout, indent=1)
+    del os.environ['NSIS_TRACE_FILE']
+    print(f"-- trace: {len(events)} events written to {tracefile}")
+    return tracefile
+
+
+def summarize(tracefile, cat=None):
+    """ Total duration (seconds) of every event name in a trace file. Returns dictionary `{name: seconds}`. """
+    with open(tracefile) as fin:
+        events = json.load(fin)['traceEvents']
+    totals = {}
+    for e in events:
+        if cat is None or e['cat'] == cat:
+            totals[e['name']] = totals.get(e['name'], 0) + e['dur'] / 1000000
+    return totals
+
+
+def install_scons_hooks():
+    """
+    Record SCons phases into the trace: SConscript reads, configure checks and every build action.
+    Must be called early in `SConstruct`.
+    """
+    import SCons.Action, SCons.SConf
+    from SCons.Script.SConscript import SConsEnvironment
+
+    org_SConscript = SConsEnvironment.SConscript
+    def SConscript(self, *args, **kw):
+        with span(str(kw.get('dirs') or (args[0] if args else 'SConscript')), 'sconscript', variant_dir=str(kw.get('variant_dir', ''))):
+            return org_SConscript(self, *args, **kw)
+    SConsEnvironment.SConscript = SConscript
+
+    # every check starts with a "Checking for ..." message and ends with a result
+    org_Display = SCons.SConf.CheckContext.Display
+    org_Result = SCons.SConf.CheckContext.Result
+    def Display(self, msg):
+        if str(msg).startswith('Checking'):
+            self.nsis_trace_check = (str(msg).strip(' .\n'), time.time())
+        return org_Display(self, msg)
+    def Result(self, res):
+        if getattr(self, 'nsis_trace_check', None):
+            name, start = self.nsis_trace_check
+            self.nsis_trace_check = None
+            record(name, 'configure', start, time.time() - start, result=str(res))
+        return org_Result(self, res)
+    SCons.SConf.CheckContext.Display = Display
+    SCons.SConf.CheckContext.Result = Result
+
+    org_call = SCons.Action._ActionAction.__call__
+    def call(self, target, source, env, *args, **kw):
+        start = time.time()
+        try:
+            return org_call(self, target, source, env, *args, **kw)
+        finally:
+            targets = [str(t) for t in (target if isinstance(target, list) else [target])]
+            record(targets[0] if targets else 'action', 'build', start, time.time() - start, targets=targets)
+    SCons.Action._ActionAction.__call__ = call
+
+
+if __name__ == '__main__':
+    from argparse import ArgumentParser
+    parser = ArgumentParser(description='Summarize a build trace, or compare two of them')
+    parser.add_argument("trace", type=str, help='Trace file')
+    parser.add_argument("baseline", type=str, nargs='?', default=None, help='Baseline trace file to compare against')
+    parser.add_argument("--cat", type=str, default=None, help='Event category (run|step|task|sconscript|configure|build|test)')
+    parser.add_argument("--top", type=int, default=40, help='Number of entries to print')
+    args = parser.parse_args()
+
+    current = summarize(args.trace, args.cat)
+    baseline = summarize(args.baseline, args.cat) if args.baseline else {}
+    names = sorted(current.keys() | baseline.keys(), key=lambda n: -max(current.get(n, 0), baseline.get(n, 0)))
+    for name in names[:args.top]:
+        if args.baseline:
+            delta = current.get(name, 0) - baseline.get(name, 0)
+            print(f"{current.get(name, 0):10.2f}s {baseline.get(name, 0):10.2f}s {delta:+10.2f}s  {name}")
+        else:
+            print(f"{current[name]:10.2f}s  {name}")
@@ -1,70 +1,191 @@
 import subprocess
 import re
 import os
+import json
+import zlib
 from os import path
+from nsis_git import GitRepository
+
+scriptdir = path.dirname(path.abspath(__file__))
 
 def nsis_version_from_history_but():
     """ Read latest version from `history.but`. Returns `(major, minor)` tuple. """
-    with open(path.join(path.dirname(__file__), 'Docs', 'src', 'history.but')) as fin:
+    with open(path.join(scriptdir, 'Docs', 'src', 'history.but')) as fin:
         matches = re.findall(r'\\H{v(\d+)\.(\d+)}', fin.read())
         # print(matches)
         return int(matches[0][0]), int(matches[0][1])
 
-def nsis_major_version():
-    major, minor = nsis_version_from_history_but()
-    return major
-
-def nsis_minor_version():
-    major, minor = nsis_version_from_history_but()
-    return minor
 
-def nsis_revision_number():
-    # git log --grep=git-svn-id: -1
-    cwd = os.curdir
-    os.chdir(path.dirname(__file__))
-    process = subprocess.Popen(['git', 'log', '--grep=git-svn-id:', '-1'], stdout=subprocess.PIPE)
+def git_output(args):
+    """ Run git in the source directory. Returns its output lines. """
+    process = subprocess.Popen(['git'] + args, stdout=subprocess.PIPE, cwd=scriptdir)
     cout = process.communicate()[0]
-    os.chdir(cwd)
-    # print(output.decode('utf-8'))
+    exitcode = process.wait()
+    if exitcode != 0:
+        raise OSError(exitcode, f"subprocess exit code {exitcode}")
+    return cout.decode('utf-8').replace('\r', '').splitlines()
 
+
+def svn_revision_from_message(message):
     # extract 7431 from "[...] git-svn-id: https://svn.code.sf.net/p/nsis/code/NSIS/trunk@7431 212acab6-be3b-0410-9dea-997c60f758d6 [...]"
-    matches = re.match(r'^.*git-svn-id:.*trunk@(\d+)\s.*$', cout.decode('utf-8'), re.DOTALL)
+    matches = re.match(r'^.*git-svn-id:.*trunk@(\d+)\s.*$', message, re.DOTALL)
     if matches is not None:
         return int(matches[1])
     return 0
 
+
+def svn_revision_from_git_log():
+    # git log --grep=git-svn-id: -1
+    return svn_revision_from_message('\n'.join(git_output(['log', '--grep=git-svn-id:', '-1'])))
+
+
+def git_repository():
+    """ Pure python reader of the source repository, or `None` if its layout is unsupported. """
+    try:
+        return GitRepository(scriptdir)
+    except (OSError, ValueError):
+        return None
+
+
+def git_head():
+    """ Returns `(commit, branch)` of the source tree. """
+    if repo := git_repository():
+        try:
+            return repo.head()
+        except (OSError, ValueError):
+            pass
+    return tuple(git_output(['rev-parse', 'HEAD', '--abbrev-ref', 'HEAD'])[:2])
+
+
+def svn_revision(commit):
+    """ svn revision of the most recent commit imported from svn, reachable from `commit`. """
+    if repo := git_repository():
+        try:
+            for sha, message in repo.log(commit):
+                if 'git-svn-id:' in message:
+                    return svn_revision_from_message(message)
+            return 0
+        except (OSError, ValueError, KeyError, zlib.error):
+            pass
+    return svn_revision_from_git_log()
+
+
+class VersionInfo:
+    """
+    NSIS version metadata (major, minor, svn revision, branch, packed version).
+    Every value is computed on first access, at most once per process.
+    The svn revision is also persisted in `cachefile`, keyed on the HEAD commit.
+    """
+    def __init__(self, cachefile=None):
+        self.cachefile = cachefile
+        self.values = {}
+
+    def _get(self, name, compute):
+        if name not in self.values:
+            self.values[name] = compute()
+        return self.values[name]
+
+    @property
+    def major(self):
+        return self._get('version', nsis_version_from_history_but)[0]
+
+    @property
+    def minor(self):
+        return self._get('version', nsis_version_from_history_but)[1]
+
+    @property
+    def head(self):
+        """ `(commit, branch)` of the source tree. """
+        return self._get('head', git_head)
+
+    @property
+    def branch(self):
+        return path.basename(self.head[1]).replace(' ', '_')
+
+    @property
+    def revision(self):
+        return self._get('revision', self._cached_revision)
+
+    def _cached_revision(self):
+        if not self.cachefile:
+            return svn_revision(self.head[0])
+        try:
+            with open(self.cachefile) as fin:
+                cached = json.load(fin)
+        except (OSError, ValueError):
+            cached = {}
+        commit = self.head[0]
+        if commit not in cached:
+            cached = dict(list(cached.items())[-15:])      # keep the most recent commits only
+            cached[commit] = svn_revision(commit)
+            try:
+                os.makedirs(path.dirname(self.cachefile), exist_ok=True)
+                tmpfile = f'{self.cachefile}.{os.getpid()}.tmp'
+                with open(tmpfile, 'w') as fout:
+                    json.dump(cached, fout, indent=2)
+                os.replace(tmpfile, self.cachefile)
+            except OSError:
+                pass    # read-only source tree
+        return cached[commit]
+
+    def packed(self, build_number=0):
+        return nsis_packed_version(self.major, self.minor, build_number=build_number)
+
+
+_version_info = None
+
+def nsis_version_info():
+    """ Version metadata of this source tree. Set `NSIS_VERSION_CACHE` to an empty string to disable the persistent cache. """
+    global _version_info
+    if _version_info is None:
+        cachefile = os.environ.get('NSIS_VERSION_CACHE', path.join(scriptdir, '.depend', 'version.json'))
+        _version_info = VersionInfo(cachefile)
+    return _version_info
+
+def nsis_major_version():
+    return nsis_version_info().major
+
+def nsis_minor_version():
+    return nsis_version_info().minor
+
+def nsis_revision_number():
+    return nsis_version_info().revision
+
 def nsis_build_number(build_number = 0):
     return build_number
 
 
 def nsis_version(
-        major_version=nsis_major_version(),
-        minor_version=nsis_minor_version(),
-        revision_number=nsis_revision_number(),
+        major_version=None,
+        minor_version=None,
+        revision_number=None,
         build_number=0):
+    """ Full version string. Missing arguments are read from the source tree. """
+    info = nsis_version_info()
+    major_version = info.major if major_version is None else major_version
+    minor_version = info.minor if minor_version is None else minor_version
+    revision_number = info.revision if revision_number is None else revision_number
     return f"{major_version}.{minor_version}.{revision_number}.{nsis_build_number(build_number)}"
 
 
 def nsis_packed_version(
-        major_version=nsis_major_version(),
-        minor_version=nsis_minor_version(),
-        revision_number=nsis_revision_number(),
+        major_version=None,
+        minor_version=None,
+        revision_number=None,
         build_number=0):
+    """ Packed version (`0xMMmmmbbb`). Missing arguments are read from the source tree. """
+    info = nsis_version_info()
+    major_version = info.major if major_version is None else major_version
+    minor_version = info.minor if minor_version is None else minor_version
     # instead of '0xMMmmmrrb' we'll use '0xMMmmmbbb'. 'bbb' range is [0, 4095]
     majver = min(major_version, 0xff)
-    minver = min(minor_version, 0xfff) 
+    minver = min(minor_version, 0xfff)
     buildno = min(nsis_build_number(build_number), 0xfff)
     return '0x%0.2x%0.3x%0.3x' % (majver, minver, buildno)
 
 
 def nsis_distro_name():
-    process = subprocess.Popen(['git', 'rev-parse', '--abbrev-ref', 'HEAD'], stdout=subprocess.PIPE)
-    (cout, cerr) = process.communicate()
-    exitcode = process.wait()
-    if exitcode != 0:
-        raise OSError(exitcode, f"subprocess exit code {exitcode}")
-
-    distro = path.basename(cout.decode('utf-8')).replace('\r', '').replace('\n', '').replace(' ', '_')      # current branch name
+    distro = nsis_version_info().branch     # current branch name
     if distro == 'master':
         distro = 'negrutiu'
     return distro
@@ -74,7 +195,7 @@ if __name__ == '__main__':
     parser = ArgumentParser()
     parser.add_argument("-b", "--build-number", type=int, default=0)
     args = parser.parse_args()
-    
+
     print(f"version={nsis_version(build_number=args.build_number)}")
     print(f"packed_version={nsis_packed_version(build_number=args.build_number)}")
     print(f"distro_name={nsis_distro_name()}")
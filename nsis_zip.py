@@ -0,0 +1,141 @@
+import hashlib
+import json
+import os
+import stat
+import struct
+import time
+import zlib
+from os import path
+
+# Parallel, reproducible zip writer for the `dist-zip` target.
+# - members are deflated in a process pool, the archive (local headers, central directory) is assembled afterwards
+# - member order, timestamps (SOURCE_DATE_EPOCH) and permissions are normalized: identical inputs give identical zips
+# - `<zip>.members.json` records the content hash of every member, compressed members are reused from the previous archive
+
+ZIP_STORED, ZIP_DEFLATED = 0, 8
+DOS_EPOCH = 315532800   # 1980-01-01, the oldest zip timestamp
+
+def dos_datetime(timestamp):
+    """ Convert a UNIX timestamp (UTC) to zip `(time, date)` fields. """
+    t = time.gmtime(max(int(timestamp), DOS_EPOCH))
+    return (t.tm_hour << 11) | (t.tm_min << 5) | (t.tm_sec // 2), ((t.tm_year - 1980) << 9) | (t.tm_mon << 5) | t.tm_mday
+
+
+def compress_member(args):
+    """ Deflate one file. Returns `(sha256, method, crc32, size, data)`. Runs in the worker processes. """
+    filepath, level = args
+    with open(filepath, 'rb') as fin:
+        content = fin.read()
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    data = compressor.compress(content) + compressor.flush()
+    method = ZIP_DEFLATED
+    if len(data) >= len(content):
+        data, method = content, ZIP_STORED
+    return hashlib.sha256(content).hexdigest(), method, zlib.crc32(content), len(content), data
+
+
+def file_sha256(filepath):
+    with open(filepath, 'rb') as fin:
+        return hashlib.file_digest(fin, 'sha256').hexdigest() if hasattr(hashlib, 'file_digest') else hashlib.sha256(fin.read()).hexdigest()
+
+
+def list_members(srcdir, arcroot):
+    """ Files of `srcdir`, sorted by archive name. Returns list of `(arcname, filepath, mode)`. """
+    members = []
+    for root, dirs, files in os.walk(srcdir):
+        for file in files:
+            filepath = path.join(root, file)
+            arcname = '/'.join([arcroot, path.relpath(filepath, srcdir).replace(os.sep, '/')] if arcroot else [path.relpath(filepath, srcdir).replace(os.sep, '/')])
+            # only the executable bit survives, the rest depends on the umask of the build machine
+            mode = 0o755 if os.stat(filepath).st_mode & stat.S_IXUSR else 0o644
+            members.append((arcname, filepath, mode))
+    return sorted(members)
+
+
+def write_zip(zippath, srcdir, arcroot=None, date_epoch=None, jobs=None, level=9, verbose=False):
+    """
+    Archive `srcdir` into `zippath`. Members are named `{arcroot}/{relpath}` (default `arcroot` is the name of `srcdir`).
+    Timestamps are `date_epoch` (i.e. `SOURCE_DATE_EPOCH`) if set, otherwise the file modification times.
+    Returns `(members, reused)` counts.
+    """
+    arcroot = path.basename(path.normpath(srcdir)) if arcroot is None else arcroot
+    members = list_members(srcdir, arcroot)
+    params = {'level': level, 'zlib': zlib.ZLIB_VERSION}
+
+    # members of the previous archive, by content hash
+    previous = {}
+    indexfile = zippath + '.members.json'
+    if path.exists(zippath) and path.exists(indexfile):
+        try:
+            with open(indexfile) as fin:
+                index = json.load(fin)
+            if index['params'] == params and index['size'] == path.getsize(zippath):
+                previous = index['members']
+        except (OSError, ValueError, KeyError):
+            pass
+
+    # hash everything first, compress only new content
+    digests = [file_sha256(filepath) for arcname, filepath, mode in members] if previous else [None] * len(members)
+    reuse = []
+    for (arcname, filepath, mode), digest in zip(members, digests):
+        entry = previous.get(arcname)
+        reuse.append(entry if entry is not None and entry[0] == digest else None)
+    todo = [(filepath, level) for (arcname, filepath, mode), reused in zip(members, reuse) if reused is None]
+    jobs = min(jobs or os.cpu_count() or 1, len(todo))
+    from contextlib import nullcontext
+    from multiprocessing import Pool
+
+    # members are written as they come out of the pool, in order: only the chunks in flight are held in memory
+    tmpfile = f'{zippath}.{os.getpid()}.tmp'
+    central, newindex = [], {}
+    with Pool(jobs) if jobs > 1 else nullcontext() as pool, \
+         open(tmpfile, 'wb') as fout, open(zippath, 'rb') if previous else open(os.devnull, 'rb') as fprev:
+        if pool is not None:
+            compressed = pool.imap(compress_member, todo, chunksize=max(1, min(16, len(todo) // (jobs * 4))))
+        else:
+            compressed = map(compress_member, todo)
+        for (arcname, filepath, mode), reused in zip(members, reuse):
+            if reused is None:
+                digest, method, crc, size, data = next(compressed)
+            else:
+                digest, method, crc, size, csize, offset = reused
+                fprev.seek(offset)
+                data = fprev.read(csize)
+            timestamp = date_epoch if date_epoch not in [None, ''] else os.stat(filepath).st_mtime
+            dostime, dosdate = dos_datetime(timestamp)
+            name = arcname.encode('utf-8')
+            flags = 0x800 if not arcname.isascii() else 0     # utf-8 names
+            header_offset = fout.tell()
+            if header_offset + len(data) > 0xffffffff or size > 0xffffffff:
+                raise ValueError(f'{zippath}: zip64 archives are not supported')
+            fout.write(struct.pack('<IHHHHHIIIHH', 0x04034b50, 20, flags, method, dostime, dosdate, crc, len(data), size, len(name), 0))
+            fout.write(name)
+            newindex[arcname] = [digest, method, crc, size, len(data), fout.tell()]
+            fout.write(data)
+            central.append(struct.pack('<IHHHHHHIIIHHHHHII', 0x02014b50, (3 << 8) | 20, 20, flags, method, dostime, dosdate, crc, len(data), size,
+                                       len(name), 0, 0, 0, 0, (stat.S_IFREG | mode) << 16, header_offset) + name)
+            if verbose:
+                print(f"{'reuse' if reused else 'deflate'}: {arcname}")
+        cdoffset = fout.tell()
+        for entry in central:
+            fout.write(entry)
+        fout.write(struct.pack('<IHHHHIIH', 0x06054b50, 0, 0, len(central), len(central), fout.tell() - cdoffset, cdoffset, 0))
+    os.replace(tmpfile, zippath)
+
+    with open(indexfile, 'w') as fout:
+        json.dump({'params': params, 'size': path.getsize(zippath), 'members': newindex}, fout)
+    return len(members), len(members) - len(todo)
+
+
+if __name__ == '__main__':
+    from argparse import ArgumentParser
+    parser = ArgumentParser(description='Reproducible zip archive of a directory')
+    parser.add_argument("zip", type=str, help='Output .zip file')
+    parser.add_argument("dir", type=str, help='Directory to archive')
+    parser.add_argument("--root", type=str, default=None, help='Root directory name inside the archive. Default is the name of the archived directory')
+    parser.add_argument("-j", "--jobs", type=int, default=None, help='Number of compression processes. Default is the number of cores')
+    parser.add_argument("-v", "--verbose", action='store_true')
+    args = parser.parse_args()
+
+    count, reused = write_zip(args.zip, args.dir, args.root, os.environ.get('SOURCE_DATE_EPOCH'), args.jobs, verbose=args.verbose)
+    print(f"-- {args.zip}: {count} members, {reused} reused")
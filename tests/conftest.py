@@ -0,0 +1,5 @@
+import sys
+from os import path
+
+# the build tools are top-level modules of the repository
+sys.path.insert(0, path.dirname(path.dirname(path.abspath(__file__))))
@@ -0,0 +1,160 @@
+import hashlib
+import io
+import os
+import tarfile
+import threading
+import time
+from functools import partial
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+from os import path
+
+import pytest
+
+from nsis_build import DependCache, cached_build, download_cppunit
+
+
+def write(file, data):
+    os.makedirs(path.dirname(file), exist_ok=True)
+    with open(file, 'wb') as fout:
+        fout.write(data)
+
+
+def read(file):
+    with open(file, 'rb') as fin:
+        return fin.read()
+
+
+def test_cache_miss_store_and_hit(tmp_path):
+    cache = DependCache(tmp_path / 'cache')
+    key = DependCache.key('zlib', 'abc', 'gcc', 'x86', ['-j4'])
+    assert key != DependCache.key('zlib', 'abc', 'gcc', 'amd64', ['-j4'])
+
+    srcdir = tmp_path / 'src'
+    assert not cache.restore(key, srcdir)
+    write(srcdir / 'lib' / 'libz.a', b'library')
+    write(srcdir / 'zlib.h', b'header')
+    cache.store(key, srcdir, [path.join('lib', 'libz.a')])
+
+    dstdir = tmp_path / 'dst'
+    assert cache.restore(key, dstdir)
+    assert read(dstdir / 'lib' / 'libz.a') == b'library'
+    assert not path.exists(dstdir / 'zlib.h')
+
+
+def test_cache_evicts_least_recently_used(tmp_path):
+    cache = DependCache(tmp_path / 'cache', max_size=250)
+    srcdir = tmp_path / 'src'
+    write(srcdir / 'out.bin', b'x' * 100)
+    for name in ['a', 'b']:
+        cache.store(name, srcdir, ['out.bin'])
+    os.utime(tmp_path / 'cache' / 'a' / 'manifest.json', ns=(1, 1))
+    os.utime(tmp_path / 'cache' / 'b' / 'manifest.json', ns=(2, 2))
+    assert cache.restore('a', tmp_path / 'dst')     # `a` is now the most recently used
+
+    cache.store('c', srcdir, ['out.bin'])
+    assert sorted(os.listdir(tmp_path / 'cache')) == ['a', 'c']
+
+
+def test_cached_build(tmp_path):
+    cache = DependCache(tmp_path / 'cache')
+    builds = []
+
+    def build(dir):
+        builds.append(dir)
+        write(dir / 'out' / 'libz.a', b'built')
+
+    srcdir = tmp_path / 'src1'
+    write(srcdir / 'zlib.c', b'source')
+    cached_build(cache, 'zlib-key', srcdir, partial(build, srcdir))
+    cached_build(cache, 'zlib-key', srcdir, partial(build, srcdir))     # stamp matches
+    assert builds == [srcdir]
+    assert read(srcdir / '.nsis-depend-key') == b'zlib-key'
+    assert os.listdir(tmp_path / 'cache' / 'zlib-key' / 'files') == ['out']
+
+    otherdir = tmp_path / 'src2'
+    write(otherdir / 'zlib.c', b'source')
+    cached_build(cache, 'zlib-key', otherdir, partial(build, otherdir))  # restored from the cache
+    assert builds == [srcdir]
+    assert read(otherdir / 'out' / 'libz.a') == b'built'
+
+
+class RangeRequestHandler(SimpleHTTPRequestHandler):
+    """ Serves `Range: bytes=N-` requests, and counts the requests. """
+    requests = []
+
+    def send_head(self):
+        self.requests.append((self.path, self.headers.get('Range')))
+        file = self.translate_path(self.path)
+        if not (range := self.headers.get('Range')) or not path.isfile(file):
+            return super().send_head()
+        data = read(file)
+        offset = int(range[len('bytes='):].rstrip('-'))
+        if offset >= len(data):
+            self.send_error(416)
+            return None
+        self.send_response(206)
+        self.send_header('Content-Length', str(len(data) - offset))
+        self.send_header('Content-Range', f'bytes {offset}-{len(data)-1}/{len(data)}')
+        self.end_headers()
+        return io.BytesIO(data[offset:])
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def http_server(tmp_path):
+    """ Local HTTP stand-in, serving `tmp_path/www`. Yields the base url. """
+    os.makedirs(tmp_path / 'www')
+    RangeRequestHandler.requests = []
+    server = ThreadingHTTPServer(('127.0.0.1', 0), partial(RangeRequestHandler, directory=str(tmp_path / 'www')))
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f'http://127.0.0.1:{server.server_address[1]}'
+    server.shutdown()
+    server.server_close()
+
+
+def make_tgz(file, version):
+    with tarfile.open(file, 'w:gz') as tf:
+        for name, data in [(f'cppunit-{version}/configure', b'#!/bin/sh\n'), (f'cppunit-{version}/src/TestCase.cpp', b'// test\n' * 1000)]:
+            info = tarfile.TarInfo(name)
+            info.size, info.mtime = len(data), time.time()
+            tf.addfile(info, io.BytesIO(data))
+    return hashlib.sha256(read(file)).hexdigest()
+
+
+def test_download_cppunit(tmp_path, http_server):
+    sha256 = make_tgz(tmp_path / 'www' / 'cppunit.tar.gz', '1.0')
+    url = f'{http_server}/cppunit.tar.gz'
+    cachedir = tmp_path / 'downloads'
+
+    download_cppunit(str(tmp_path / 'a' / 'cppunit'), '1.0', sha256, url=url, cachedir=str(cachedir))
+    assert read(tmp_path / 'a' / 'cppunit' / 'configure') == b'#!/bin/sh\n'
+    assert read(cachedir / 'cppunit-1.0.tar.gz') == read(tmp_path / 'www' / 'cppunit.tar.gz')
+    assert RangeRequestHandler.requests == [('/cppunit.tar.gz', None)]
+
+    # the cached archive is extracted without network access
+    download_cppunit(str(tmp_path / 'b' / 'cppunit'), '1.0', sha256, url=url, cachedir=str(cachedir))
+    assert path.isfile(tmp_path / 'b' / 'cppunit' / 'src' / 'TestCase.cpp')
+    assert len(RangeRequestHandler.requests) == 1
+
+
+def test_download_cppunit_resumes(tmp_path, http_server):
+    sha256 = make_tgz(tmp_path / 'www' / 'cppunit.tar.gz', '1.0')
+    cachedir = tmp_path / 'downloads'
+    write(cachedir / 'cppunit-1.0.tar.gz.part', read(tmp_path / 'www' / 'cppunit.tar.gz')[:100])
+
+    download_cppunit(str(tmp_path / 'cppunit'), '1.0', sha256, url=f'{http_server}/cppunit.tar.gz', cachedir=str(cachedir))
+    assert RangeRequestHandler.requests == [('/cppunit.tar.gz', 'bytes=100-')]
+    assert read(cachedir / 'cppunit-1.0.tar.gz') == read(tmp_path / 'www' / 'cppunit.tar.gz')
+    assert path.isfile(tmp_path / 'cppunit' / 'configure')
+
+
+def test_download_cppunit_sha256_mismatch(tmp_path, http_server):
+    make_tgz(tmp_path / 'www' / 'cppunit.tar.gz', '1.0')
+    cachedir = tmp_path / 'downloads'
+    with pytest.raises(Exception, match='sha256 mismatch'):
+        download_cppunit(str(tmp_path / 'cppunit'), '1.0', '0' * 64, url=f'{http_server}/cppunit.tar.gz', cachedir=str(cachedir))
+    assert not path.exists(tmp_path / 'cppunit')
+    assert not path.exists(cachedir / 'cppunit-1.0.tar.gz')
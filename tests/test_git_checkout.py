@@ -0,0 +1,77 @@
+import os
+import shutil
+import subprocess
+from os import path
+
+import pytest
+
+from nsis_build import git_checkout, git_revision
+
+
+def git(*args, cwd=None):
+    return subprocess.run(['git', '-c', 'user.name=test', '-c', 'user.email=test@example.com', '-c', 'init.defaultBranch=master'] + list(args),
+                          cwd=cwd, check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE).stdout.decode().strip()
+
+
+def commit(workdir, file, text):
+    with open(path.join(workdir, file), 'w') as fout:
+        fout.write(text)
+    git('add', file, cwd=workdir)
+    git('commit', '--quiet', '-m', text, cwd=workdir)
+    return git('rev-parse', 'HEAD', cwd=workdir)
+
+
+@pytest.fixture
+def remote(tmp_path):
+    """ Local bare repository stand-in with two commits. Yields `(url, [commit1, commit2])`. """
+    workdir = str(tmp_path / 'upstream')
+    git('init', '--quiet', workdir)
+    commits = [commit(workdir, 'zlib.h', 'v1'), commit(workdir, 'zlib.h', 'v2')]
+    git('clone', '--quiet', '--bare', workdir, str(tmp_path / 'remote.git'))
+    yield 'file://' + str(tmp_path / 'remote.git').replace(os.sep, '/'), commits
+
+
+def test_clone_and_pull(tmp_path, remote):
+    url, commits = remote
+    dir = str(tmp_path / 'deps' / 'zlib')
+    git_checkout(url, dir)
+    assert git_revision(dir) == commits[1]
+    assert git('rev-list', '--count', 'HEAD', cwd=dir) == '1'    # shallow
+    git_checkout(url, dir)
+    assert git_revision(dir) == commits[1]
+
+    git_checkout(url, str(tmp_path / 'deps' / 'full'), depth=0)
+    assert git('rev-list', '--count', 'HEAD', cwd=str(tmp_path / 'deps' / 'full')) == '2'
+
+
+def test_pinned_revision(tmp_path, remote):
+    url, commits = remote
+    dir = str(tmp_path / 'zlib')
+    git_checkout(url, dir, revision=commits[0])
+    assert git_revision(dir) == commits[0]
+    with open(path.join(dir, 'zlib.h')) as fin:
+        assert fin.read() == 'v1'
+
+    # already at the pinned revision: no git traffic at all
+    shutil.rmtree(tmp_path / 'remote.git')
+    git_checkout(url, dir, revision=commits[0])
+    assert git_revision(dir) == commits[0]
+
+
+def test_pinned_revision_with_refcache(tmp_path, remote):
+    url, commits = remote
+    refcache = str(tmp_path / 'refcache.git')
+    for name, revision in [('x86', commits[0]), ('amd64', commits[1])]:
+        git_checkout(url, str(tmp_path / name / 'zlib'), revision=revision, refcache=refcache)
+        assert git_revision(str(tmp_path / name / 'zlib')) == revision
+
+    # the objects are stored in the reference cache only
+    with open(tmp_path / 'x86' / 'zlib' / '.git' / 'objects' / 'info' / 'alternates') as fin:
+        assert fin.read().splitlines() == [path.join(refcache, 'objects')]
+    assert git('count-objects', cwd=str(tmp_path / 'x86' / 'zlib')).startswith('0 objects')
+    assert git('cat-file', '-t', commits[1], cwd=refcache) == 'commit'
+
+    # a new checkout of a cached revision doesn't need the remote
+    shutil.rmtree(tmp_path / 'remote.git')
+    git_checkout(url, str(tmp_path / 'other' / 'zlib'), revision=commits[0], refcache=refcache)
+    assert git_revision(str(tmp_path / 'other' / 'zlib')) == commits[0]
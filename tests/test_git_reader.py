@@ -0,0 +1,69 @@
+import subprocess
+from glob import glob
+from os import path
+
+import pytest
+
+from nsis_git import GitRepository
+
+
+def git(*args, cwd=None):
+    return subprocess.run(['git', '-c', 'user.name=test', '-c', 'user.email=test@example.com', '-c', 'init.defaultBranch=master'] + list(args),
+                          cwd=cwd, check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE).stdout
+
+
+@pytest.fixture
+def workdir(tmp_path):
+    """ Repository with enough similar revisions of a file for `git repack` to store deltas. """
+    workdir = str(tmp_path / 'repo')
+    git('init', '--quiet', workdir)
+    lines = [f'line {i}\n' for i in range(2000)]
+    for i in range(12):
+        lines[i * 97] = f'changed in revision {i}\n'
+        with open(path.join(workdir, 'file.txt'), 'w') as fout:
+            fout.writelines(lines)
+        git('add', 'file.txt', cwd=workdir)
+        git('commit', '--quiet', '-m', f'revision {i}', cwd=workdir)
+    return workdir
+
+
+def all_objects(workdir):
+    """ Returns `{sha: type}` of every object, as listed by `git cat-file`. """
+    output = git('cat-file', '--batch-all-objects', '--batch-check=%(objectname) %(objecttype)', cwd=workdir).decode()
+    return dict(line.split(' ') for line in output.splitlines())
+
+
+def check_objects(workdir):
+    objects = all_objects(workdir)
+    assert objects
+    repo = GitRepository(workdir)
+    for sha, type in objects.items():
+        assert repo.read(sha) == (type, git('cat-file', type, sha, cwd=workdir)), sha
+
+
+def test_loose_objects(workdir):
+    check_objects(workdir)
+
+
+@pytest.mark.parametrize('ofs_delta', ['true', 'false'])
+def test_packed_objects(workdir, ofs_delta):
+    git('-c', f'repack.useDeltaBaseOffset={ofs_delta}', 'repack', '--quiet', '-a', '-d', '-f', cwd=workdir)
+    git('prune-packed', cwd=workdir)
+    pack = glob(path.join(workdir, '.git', 'objects', 'pack', '*.idx'))
+    assert len(pack) == 1 and git('count-objects', cwd=workdir).startswith(b'0 objects')
+    assert 'chain length = 1' in git('verify-pack', '-v', pack[0]).decode()     # deltas were stored
+    check_objects(workdir)
+
+
+def test_refs_and_log(workdir):
+    git('pack-refs', '--all', cwd=workdir)
+    repo = GitRepository(workdir)
+    head = git('rev-parse', 'HEAD', cwd=workdir).decode().strip()
+    assert repo.head() == (head, 'master')
+    assert [sha for sha, message in repo.log(head)] == git('log', '--format=%H', cwd=workdir).decode().split()
+
+    parent = git('rev-parse', 'HEAD~1', cwd=workdir).decode().strip()
+    git('checkout', '--quiet', '--detach', parent, cwd=workdir)
+    assert repo.head() == (parent, 'HEAD')
+    with pytest.raises(KeyError):
+        repo.read('0' * 40)
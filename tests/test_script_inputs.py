@@ -0,0 +1,123 @@
+import os
+from os import path
+
+import pytest
+
+from nsis_test_scripts import DependencyScanner, ResultCache
+
+
+def write(file, text=''):
+    os.makedirs(path.dirname(file), exist_ok=True)
+    with open(file, 'w') as fout:
+        fout.write(text)
+
+
+@pytest.fixture
+def nsisdir(tmp_path):
+    """ Minimal NSIS distribution. """
+    nsisdir = tmp_path / 'nsis'
+    write(nsisdir / 'makensis', 'makensis')
+    write(nsisdir / 'nsisconf.nsh')
+    write(nsisdir / 'Stubs' / 'zlib-x86-unicode', 'stub')
+    write(nsisdir / 'Include' / 'Pages.nsh', '\n'.join([
+        '!include LogicLib.nsh',
+        '!macro PAGE_LICENSE FILE',
+        '  LicenseData "${FILE}"',
+        '!macroend',
+        '!macro PAGE_ICON NAME',
+        '  Icon "${NSISDIR}\\Contrib\\Graphics\\${NAME}"',
+        '!macroend',
+    ]))
+    write(nsisdir / 'Include' / 'LogicLib.nsh')
+    write(nsisdir / 'Include' / 'Unused.nsh')
+    write(nsisdir / 'Contrib' / 'Graphics' / 'modern.ico')
+    write(nsisdir / 'Contrib' / 'Graphics' / 'classic.ico')
+    write(nsisdir / 'Plugins' / 'x86-unicode' / 'nsDialogs.dll')
+    write(nsisdir / 'Plugins' / 'x86-unicode' / 'Banner.dll')
+    return nsisdir
+
+
+@pytest.fixture
+def script(tmp_path):
+    scriptdir = tmp_path / 'tests'
+    write(scriptdir / 'test.nsi', '\n'.join([
+        '!include "Pages.nsh"',
+        '!addincludedir include',
+        '!include local.nsh',
+        '!insertmacro PAGE_LICENSE license.txt',
+        '!insertmacro PAGE_ICON modern.ico',
+        '; !include Unused.nsh',
+        'Section',
+        '  File /r data',
+        '  File "files\\*.txt"',
+        '  nsDialogs::Create 1018',
+        'SectionEnd',
+    ]))
+    write(scriptdir / 'include' / 'local.nsh')
+    write(scriptdir / 'license.txt')
+    write(scriptdir / 'data' / 'a.bin')
+    write(scriptdir / 'data' / 'sub' / 'b.bin')
+    write(scriptdir / 'files' / 'c.txt')
+    write(scriptdir / 'files' / 'd.dat')
+    return scriptdir / 'test.nsi'
+
+
+def relpaths(files, tmp_path):
+    return sorted(path.relpath(file, tmp_path).replace(os.sep, '/') for file in files)
+
+
+def test_scan(tmp_path, nsisdir, script):
+    scanner = DependencyScanner(str(nsisdir), str(nsisdir / 'makensis'))
+    inputs, cacheable = scanner.scan(str(script))
+    assert cacheable
+    assert relpaths(inputs, tmp_path) == [
+        'nsis/Contrib/Graphics/modern.ico',
+        'nsis/Include/LogicLib.nsh',
+        'nsis/Include/Pages.nsh',
+        'nsis/Plugins/x86-unicode/nsDialogs.dll',
+        'nsis/Stubs/zlib-x86-unicode',
+        'nsis/makensis',
+        'nsis/nsisconf.nsh',
+        'tests/data/a.bin',
+        'tests/data/sub/b.bin',
+        'tests/files/c.txt',
+        'tests/include/local.nsh',
+        'tests/license.txt',
+        'tests/test.nsi',
+    ]
+
+
+def test_uncacheable(tmp_path, nsisdir):
+    write(tmp_path / 'system.nsi', '!system "echo hello"\n')
+    scanner = DependencyScanner(str(nsisdir), str(nsisdir / 'makensis'))
+    assert scanner.scan(str(tmp_path / 'system.nsi'))[1] is False
+    assert scanner.key('system.nsi', str(tmp_path / 'system.nsi')) is None
+
+
+def test_key(tmp_path, nsisdir, script):
+    def key():
+        return DependencyScanner(str(nsisdir), str(nsisdir / 'makensis')).key('test.nsi', str(script))
+
+    initial = key()
+    assert initial is not None and key() == initial
+    write(nsisdir / 'Include' / 'Unused.nsh', '!define CHANGED')
+    write(nsisdir / 'Plugins' / 'x86-unicode' / 'Banner.dll', 'changed')
+    assert key() == initial
+    write(nsisdir / 'Plugins' / 'x86-unicode' / 'nsDialogs.dll', 'changed')
+    assert key() != initial
+
+
+def test_result_cache(tmp_path):
+    file = str(tmp_path / 'cache' / 'results.json')
+    cache = ResultCache(file, limit=2)
+    assert cache.get('a') is None and cache.get(None) is None
+    for key in ['a', 'b', 'c']:
+        cache.set(key, {'name': f'{key}.nsi', 'duration': 1.0, 'peak_rss': 1024, 'size': 4096, 'status': 'passed'})
+    cache.set(None, {'name': 'uncacheable.nsi', 'duration': 1.0, 'peak_rss': 1024, 'size': 4096})
+    assert cache.get('b') == {'name': 'b.nsi', 'duration': 1.0, 'peak_rss': 1024, 'size': 4096}
+    cache.save()
+
+    # the most recently used entries are kept
+    cache = ResultCache(file, limit=2)
+    assert sorted(cache.entries) == ['b', 'c']
+    assert cache.get('b')['name'] == 'b.nsi'
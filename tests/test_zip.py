@@ -0,0 +1,69 @@
+import os
+import stat
+import zipfile
+from os import path
+
+import pytest
+
+from nsis_zip import write_zip
+
+EPOCH = 1700000000
+
+
+@pytest.fixture
+def srcdir(tmp_path):
+    """ Distribution tree with compressible, incompressible and executable files. """
+    srcdir = tmp_path / 'nsis-3.0'
+    for i in range(40):
+        os.makedirs(srcdir / 'Include' / f'dir{i % 4}', exist_ok=True)
+        with open(srcdir / 'Include' / f'dir{i % 4}' / f'header{i}.nsh', 'w') as fout:
+            fout.write(f'!define HEADER{i}\n' * (i * 50 + 1))
+        with open(srcdir / f'random{i}.bin', 'wb') as fout:
+            fout.write(os.urandom(i * 300))
+    os.chmod(srcdir / 'random1.bin', 0o700)
+    return srcdir
+
+
+def read(file):
+    with open(file, 'rb') as fin:
+        return fin.read()
+
+
+@pytest.mark.parametrize('jobs', [1, 4])
+def test_reproducible(tmp_path, srcdir, jobs):
+    assert write_zip(str(tmp_path / 'a.zip'), str(srcdir), date_epoch=EPOCH, jobs=jobs) == (80, 0)
+    first = read(tmp_path / 'a.zip')
+    os.remove(tmp_path / 'a.zip')
+    for file in srcdir.rglob('*'):
+        os.utime(file, (0, 0))      # file times are ignored
+    assert write_zip(str(tmp_path / 'a.zip'), str(srcdir), date_epoch=EPOCH, jobs=5 - jobs) == (80, 0)
+    assert read(tmp_path / 'a.zip') == first
+
+    with zipfile.ZipFile(tmp_path / 'a.zip') as zf:
+        assert zf.testzip() is None
+        infos = zf.infolist()
+        assert [info.filename for info in infos] == sorted(info.filename for info in infos)
+        assert all(info.filename.startswith('nsis-3.0/') for info in infos)
+        assert {info.date_time for info in infos} == {(2023, 11, 14, 22, 13, 20)}
+        assert zf.read('nsis-3.0/Include/dir1/header5.nsh') == read(srcdir / 'Include' / 'dir1' / 'header5.nsh')
+        modes = {info.filename: stat.S_IMODE(info.external_attr >> 16) for info in infos}
+        assert modes['nsis-3.0/random1.bin'] == 0o755 and modes['nsis-3.0/random2.bin'] == 0o644
+
+
+def test_reuses_unchanged_members(tmp_path, srcdir):
+    zippath = str(tmp_path / 'a.zip')
+    write_zip(zippath, str(srcdir), date_epoch=EPOCH, jobs=2)
+    first = read(zippath)
+    assert write_zip(zippath, str(srcdir), date_epoch=EPOCH, jobs=2) == (80, 80)
+    assert read(zippath) == first
+
+    with open(srcdir / 'random3.bin', 'wb') as fout:
+        fout.write(b'changed' * 100)
+    assert write_zip(zippath, str(srcdir), date_epoch=EPOCH, jobs=2) == (80, 79)
+    updated = read(zippath)
+    os.remove(zippath)
+    write_zip(zippath, str(srcdir), date_epoch=EPOCH, jobs=2)
+    assert read(zippath) == updated
+    with zipfile.ZipFile(zippath) as zf:
+        assert zf.testzip() is None
+        assert zf.read('nsis-3.0/random3.bin') == b'changed' * 100